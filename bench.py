@@ -0,0 +1,513 @@
+""" Бенчмарк полного прогона main/process_table без реальных API.
+
+TGStat и видео постов отдаются локальным HTTP-сервером (с Range-запросами), OpenAI, TwelveLabs и Google Sheets подменяются фейками.
+Все ответы берутся из bench/fixtures, задержки задаются флагами.
+
+    python bench.py --scales 10,100,1000 --clients 1 --tgstat-latency 0.05 --openai-latency 0.5
+"""
+import os
+import sys
+import json
+import time
+import random
+import struct
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from types import SimpleNamespace
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench", "fixtures")
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class Calls:
+    """Thread-safe call counter per endpoint"""
+
+    def __init__(self):
+        self.counts = Counter()
+        self.tokens = Counter()
+        self._lock = threading.Lock()
+
+    def add(self, endpoint, prompt_tokens=0, completion_tokens=0):
+        with self._lock:
+            self.counts[endpoint] += 1
+            self.tokens["prompt"] += prompt_tokens
+            self.tokens["completion"] += completion_tokens
+
+
+CALLS = Calls()
+
+
+# ================== VIDEOS ==================
+# Длительности роликов по кругу: первый короче VIDEO_MIN_SECONDS и должен пропускаться
+CLIP_DURATIONS = (2, 30, 95, 600)
+
+
+def make_mp4(clip, payload_size=512 * 1024):
+    """Minimal mp4 (ftyp, moov/mvhd, mdat) with pseudo-random payload; odd clips keep moov at the end"""
+    timescale = 1000
+    mvhd = struct.pack(">I4sB3xIIII", 108, b"mvhd", 0, 0, 0, timescale, CLIP_DURATIONS[clip % len(CLIP_DURATIONS)] * timescale)
+    mvhd += bytes(108 - len(mvhd))
+    moov = struct.pack(">I4s", 8 + len(mvhd), b"moov") + mvhd
+    ftyp = struct.pack(">I4s4sI", 16, b"ftyp", b"isom", 512)
+    mdat = struct.pack(">I4s", 8 + payload_size, b"mdat") + random.Random(clip).randbytes(payload_size)
+    return ftyp + (mdat + moov if clip % 2 else moov + mdat)
+
+
+# ================== TGSTAT ==================
+def start_tgstat_server(fixtures, latency, clips):
+    """Local stand-in for api.tgstat.ru built from recorded responses; also serves post videos with Range support"""
+    template_posts = fixtures["channels/posts"]["response"]["items"]
+    template_stats = fixtures["posts/stat"]["response"]
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            parsed = urlparse(self.path)
+            params = {k: v[0] for k, v in parse_qs(parsed.query).items()}
+            if parsed.path.startswith("/videos/"):
+                return self.send_video(parsed.path)
+            endpoint = parsed.path.strip("/")
+            CALLS.add(f"tgstat {endpoint}")
+            time.sleep(latency)
+
+            if endpoint == "channels/get":
+                username = params["channelId"].rstrip("/").split("/")[-1].lstrip("@")
+                body = json.loads(json.dumps(fixtures["channels/get"]))
+                body["response"].update({
+                    "id": abs(hash(username)) % 10 ** 8,
+                    "username": f"@{username}",
+                    "title": f"{body['response']['title']} {username}",
+                })
+            elif endpoint == "channels/posts":
+                channel_id = params["channelId"]
+                now = int(time.time())
+                items = []
+                for i in range(int(params.get("limit", 50))):
+                    post = dict(template_posts[i % len(template_posts)])
+                    post["id"] = 10 ** 6 + i
+                    post["date"] = now - i * 3 * 3600
+                    post["link"] = f"t.me/{channel_id}/{10 ** 6 + i}"
+                    post["views"] = post["views"] + (i * 137) % 900
+                    if post.get("media", {}).get("file_url", "").endswith(".mp4"):
+                        # одни и те же ролики повторяются в разных постах и каналах
+                        base_url = f"http://127.0.0.1:{self.server.server_port}"
+                        post["media"] = dict(post["media"], file_url=f"{base_url}/videos/{channel_id}/{i}.mp4")
+                    items.append(post)
+                body = {"status": "ok", "response": {"count": len(items), "items": items}}
+            elif endpoint == "posts/stat":
+                # статистика разная для разных постов, чтобы ранжирование было не тривиальным
+                seed = sum(map(ord, params["postId"]))
+                stats = dict(template_stats)
+                stats["viewsCount"] = template_stats["viewsCount"] + seed % 3000
+                stats["reactionsCount"] = template_stats["reactionsCount"] + seed % 97
+                stats["commentsCount"] = template_stats["commentsCount"] + seed % 13
+                stats["forwardsCount"] = template_stats["forwardsCount"] + seed % 29
+                body = {"status": "ok", "response": stats}
+            else:
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_video(self, path):
+            CALLS.add("video GET")
+            data = clip_data(random.Random(path.rsplit("/", 1)[-1]).randrange(clips))
+            start, end = 0, len(data) - 1
+            byte_range = self.headers.get("Range", "")
+            if byte_range.startswith("bytes="):
+                first, _, last = byte_range[len("bytes="):].partition("-")
+                start, end = int(first), min(int(last), end) if last else end
+            self.send_response(206 if byte_range else 200)
+            if byte_range:
+                self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Content-Length", str(end - start + 1))
+            self.end_headers()
+            self.wfile.write(data[start:end + 1])
+
+    clip_cache = {}
+
+    def clip_data(clip):
+        if clip not in clip_cache:
+            clip_cache[clip] = make_mp4(clip)
+        return clip_cache[clip]
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# ================== OPENAI ==================
+class FakeOpenAI:
+    """chat.completions.create and the Batch API answering from fixtures by prompt kind"""
+
+    def __init__(self, fixtures, latency):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+        self.files = SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch, cancel=self._cancel_batch)
+        self._files = {}
+        self._batches = {}
+
+    def _answer(self, messages):
+        prompt = messages[-1]["content"]
+        system = messages[0]["content"] if messages[0]["role"] == "system" else ""
+        if "JSON-массивом" in prompt:
+            count = int(prompt.split("JSON-массивом из ", 1)[1].split()[0])
+            items = [dict(self.fixtures["analysis"], index=i) for i in range(count)]
+            return "analysis_batch", "```json\n" + json.dumps(items, ensure_ascii=False) + "\n```"
+        if "JSON" in prompt:
+            return "analysis", json.dumps(self.fixtures["analysis"], ensure_ascii=False)
+        if "Сократи" in prompt:
+            return "compaction", self.fixtures["rewrite"]
+        if "Переведи" in prompt:
+            return "translation", self.fixtures["translation"]
+        if "креативный директор" in system:
+            return "video_suggestion", self.fixtures["video_suggestion"]
+        return "rewrite", self.fixtures["rewrite"]
+
+    def create(self, model, messages, temperature=None, **kwargs):
+        time.sleep(self.latency)
+        kind, content = self._answer(messages)
+        prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+        completion_tokens = len(content) // 4
+        CALLS.add(f"openai {model} {kind}", prompt_tokens, completion_tokens)
+        usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                                total_tokens=prompt_tokens + completion_tokens)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+
+    def _create_file(self, file, purpose):
+        CALLS.add("openai files.create")
+        file_id = f"file-{len(self._files)}"
+        self._files[file_id] = file.read().decode("utf-8")
+        return SimpleNamespace(id=file_id)
+
+    def _file_content(self, file_id):
+        CALLS.add("openai files.content")
+        return SimpleNamespace(text=self._files[file_id])
+
+    def _create_batch(self, input_file_id, endpoint, completion_window, **kwargs):
+        CALLS.add("openai batches.create")
+        output = []
+        for line in self._files[input_file_id].splitlines():
+            request = json.loads(line)
+            body = request["body"]
+            kind, content = self._answer(body["messages"])
+            prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 4
+            CALLS.add(f"openai batch {body['model']} {kind}", prompt_tokens, len(content) // 4)
+            output.append({"custom_id": request["custom_id"], "response": {"status_code": 200, "body": {
+                "model": body["model"],
+                "choices": [{"message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4}}}})
+        batch_id = f"batch-{len(self._batches)}"
+        output_file_id = f"file-{len(self._files)}"
+        self._files[output_file_id] = "\n".join(json.dumps(item, ensure_ascii=False) for item in output)
+        # первый опрос — in_progress, второй — completed
+        self._batches[batch_id] = {"polls": 0, "output_file_id": output_file_id}
+        return SimpleNamespace(id=batch_id, status="validating")
+
+    def _retrieve_batch(self, batch_id):
+        CALLS.add("openai batches.retrieve")
+        batch = self._batches[batch_id]
+        batch["polls"] += 1
+        if batch["polls"] < 2:
+            return SimpleNamespace(id=batch_id, status="in_progress", output_file_id=None, error_file_id=None)
+        return SimpleNamespace(id=batch_id, status="completed", output_file_id=batch["output_file_id"], error_file_id=None)
+
+    def _cancel_batch(self, batch_id):
+        CALLS.add("openai batches.cancel")
+
+
+# ================== TWELVELABS ==================
+class FakeTwelveLabs:
+    def __init__(self, fixtures, latency):
+        self.fixtures = fixtures
+        self.latency = latency
+        self._indexes = []
+        self._tasks = {}
+        self._lock = threading.Lock()
+        self.indexes = SimpleNamespace(list=self._list_indexes, create=self._create_index)
+        self.tasks = SimpleNamespace(create=self._create_task, retrieve=self._retrieve_task)
+
+    def _call(self, endpoint):
+        CALLS.add(f"twelvelabs {endpoint}")
+        time.sleep(self.latency)
+
+    def _list_indexes(self, **kwargs):
+        self._call("indexes.list")
+        return list(self._indexes)
+
+    def _create_index(self, index_name, models):
+        self._call("indexes.create")
+        index = SimpleNamespace(id=f"index-{len(self._indexes)}", index_name=index_name)
+        self._indexes.append(index)
+        return index
+
+    def _create_task(self, index_id, video_url, **kwargs):
+        self._call("tasks.create")
+        with self._lock:
+            task_id = f"task-{len(self._tasks)}"
+            self._tasks[task_id] = 0
+        return SimpleNamespace(id=task_id, video_id=f"video-{task_id}", status="pending")
+
+    def _retrieve_task(self, task_id, **kwargs):
+        self._call("tasks.retrieve")
+        with self._lock:
+            self._tasks[task_id] += 1
+            polls = self._tasks[task_id]
+        status = "ready" if polls >= self.fixtures["polls_until_ready"] else "indexing"
+        return SimpleNamespace(id=task_id, video_id=f"video-{task_id}", status=status)
+
+    def summarize(self, video_id, type, prompt):
+        self._call("summarize")
+        return SimpleNamespace(summary=self.fixtures["summary"])
+
+
+# ================== SHEETS ==================
+class FakeWorksheet:
+    def __init__(self, title, latency, rows=None):
+        self.title = title
+        self.latency = latency
+        self.data = [list(row) for row in rows or []]
+        self.col_count = 20
+        self.row_count = max(1000, len(self.data))
+        self._lock = threading.Lock()
+
+    def _call(self, method):
+        CALLS.add(f"sheets {method}")
+        time.sleep(self.latency)
+
+    def _range_start(self, range_name):
+        return int(range_name.split(":")[0].lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ") or 1)
+
+    def get_all_values(self):
+        self._call("get_all_values")
+        return [list(row) for row in self.data]
+
+    def get_all_records(self):
+        self._call("get_all_records")
+        header, *rows = self.data
+        return [dict(zip(header, row)) for row in rows]
+
+    def row_values(self, row):
+        self._call("row_values")
+        return list(self.data[row - 1]) if row <= len(self.data) else []
+
+    def get_values(self, range_name):
+        self._call("get_values")
+        start, end = (int(x) for x in range_name.split(":"))
+        return [list(row) for row in self.data[start - 1:end]]
+
+    def cell(self, row, col):
+        self._call("cell")
+        value = self.data[row - 1][col - 1] if row <= len(self.data) and col <= len(self.data[row - 1]) else ""
+        return SimpleNamespace(value=value)
+
+    def clear(self):
+        self._call("clear")
+        self.data = []
+
+    def append_row(self, values, **kwargs):
+        self._call("append_row")
+        self.data.append(list(values))
+
+    def append_rows(self, values, **kwargs):
+        self._call("append_rows")
+        self.data.extend(list(row) for row in values)
+        self.row_count = max(self.row_count, len(self.data))
+
+    def insert_rows(self, values, row=1, **kwargs):
+        self._call("insert_rows")
+        self.data[row - 1:row - 1] = [list(v) for v in values]
+        self.row_count += len(values)
+
+    def update(self, range_name=None, values=None, **kwargs):
+        self._call("update")
+        start = self._range_start(range_name)
+        if start - 1 + len(values) > self.row_count:
+            # как Sheets API: update не расширяет сетку
+            raise Exception(f"Range exceeds grid limits: {start - 1 + len(values)} > {self.row_count} rows")
+        for offset, row in enumerate(values):
+            while len(self.data) < start + offset:
+                self.data.append([])
+            self.data[start - 1 + offset] = list(row)
+
+    def batch_update(self, data, **kwargs):
+        self._call("batch_update")
+
+    def add_cols(self, count):
+        self._call("add_cols")
+        self.col_count += count
+
+    def add_rows(self, count):
+        self._call("add_rows")
+        self.row_count += count
+
+
+class FakeSpreadsheet:
+    def __init__(self, worksheets, latency):
+        self.latency = latency
+        self.worksheets = worksheets
+
+    def worksheet(self, title):
+        CALLS.add("sheets worksheet")
+        import gspread
+        if title not in self.worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.worksheets[title]
+
+    def add_worksheet(self, title, rows, cols):
+        CALLS.add("sheets add_worksheet")
+        self.worksheets[title] = FakeWorksheet(title, self.latency)
+        return self.worksheets[title]
+
+
+class FakeGspread:
+    def __init__(self, spreadsheets):
+        self.spreadsheets = spreadsheets
+
+    def open_by_url(self, url):
+        CALLS.add("sheets open_by_url")
+        return self.spreadsheets[url]
+
+
+# ================== RUN ==================
+def run_scale(args):
+    """Single benchmark run in this process; prints a JSON result line"""
+    cache_dir = tempfile.mkdtemp(prefix="bench-cache-")
+    os.environ["CACHE_DIR"] = cache_dir
+    os.environ["METRICS_EXPORT_PATH"] = os.path.join(cache_dir, "metrics.json")
+    os.environ.setdefault("TGSTAT_API_KEY", "bench")
+    os.environ["TGSTAT_RATE_PER_SECOND"] = str(args.tgstat_rps)
+    os.environ["TGSTAT_BURST"] = str(max(1, int(args.tgstat_rps)))
+    os.environ["VIDEO_POLL_MIN_INTERVAL"] = str(args.video_poll)
+    os.environ["VIDEO_POLL_MAX_INTERVAL"] = str(args.video_poll * 4)
+    os.environ["OPENAI_BATCH_POLL_INTERVAL"] = str(args.video_poll)
+    server = start_tgstat_server(load_fixture("tgstat.json"), args.tgstat_latency, args.video_clips)
+    os.environ["TGSTAT_BASE_URL"] = f"http://127.0.0.1:{server.server_port}"
+
+    import logging
+    import get_stats
+
+    get_stats.logger.setLevel(logging.WARNING)
+    get_stats.EXTRACTED_DATA_DIR = os.path.join(cache_dir, "extracted_data")
+    random.seed(0)
+
+    sheets = load_fixture("sheets.json")
+    spreadsheets = {}
+    main_rows = [["id", "Name", "URL", "Scheduler Status", "Processing"]]
+    for client in range(args.clients):
+        url = f"https://docs.google.com/spreadsheets/d/bench-{client}"
+        channels = [["link"]] + [[f"https://t.me/bench_channel_{(client * args.overlap + i) % (args.scale * args.clients)}"]
+                                 for i in range(args.scale)]
+        spreadsheets[url] = FakeSpreadsheet({
+            get_stats.PROFILE: FakeWorksheet(get_stats.PROFILE, args.sheets_latency, [[sheets["profile"]]]),
+            get_stats.CHANNELS: FakeWorksheet(get_stats.CHANNELS, args.sheets_latency, channels),
+            get_stats.SUGGESTIONS: FakeWorksheet(get_stats.SUGGESTIONS, args.sheets_latency),
+        }, args.sheets_latency)
+        main_rows.append([str(client + 1), f"bench-{client}", url, "Start", ""])
+
+    get_stats.ctx.override(
+        openai=FakeOpenAI(load_fixture("openai.json"), args.openai_latency),
+        twelvelabs=FakeTwelveLabs(load_fixture("twelvelabs.json"), args.twelvelabs_latency),
+        gs_client=FakeGspread(spreadsheets),
+        admin_main=FakeWorksheet(get_stats.MAIN, args.sheets_latency, main_rows),
+        admin_log=FakeWorksheet(get_stats.LOG, args.sheets_latency),
+        openai_sys_role="Ты эксперт по контенту для аграрного бизнеса.",
+        pegasus_sys_role="Describe the video and transcribe the speech.",
+    )
+
+    start = time.perf_counter()
+    get_stats.main()
+    wall = time.perf_counter() - start
+    server.shutdown()
+
+    # суммарное время по стадиям из метрик самого пайплайна
+    stages = Counter()
+    with open(os.environ["METRICS_EXPORT_PATH"], "r", encoding="utf-8") as f:
+        for timing in json.load(f)["timings"]:
+            if timing["name"] in ("stage_seconds", "ai_stage_seconds"):
+                stages[timing["labels"]["stage"]] += timing["sum"]
+
+    print(json.dumps({
+        "scale": args.scale,
+        "clients": args.clients,
+        "wall_s": round(wall, 3),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "calls": dict(sorted(CALLS.counts.items())),
+        "tokens": dict(CALLS.tokens),
+        "stages_s": {stage: round(seconds, 3) for stage, seconds in sorted(stages.items())},
+    }, ensure_ascii=False))
+
+
+def print_report(results):
+    for result in results:
+        print(f"\n=== {result['scale']} каналов × {result['clients']} клиентов ===")
+        print(f"wall time: {result['wall_s']:.2f} s, peak RSS: {result['peak_rss_mb']:.1f} MB")
+        print(f"tokens: prompt ≈{result['tokens'].get('prompt', 0)}, completion ≈{result['tokens'].get('completion', 0)}")
+        print("stages (сумма по потокам): " + ", ".join(f"{k} {v:.2f} s" for k, v in result["stages_s"].items()))
+        for endpoint, count in result["calls"].items():
+            print(f"  {endpoint:<45} {count}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the TGStat -> AI -> Sheets pipeline")
+    parser.add_argument("--scales", default="10,100,1000", help="channel counts per client, comma-separated")
+    parser.add_argument("--clients", type=int, default=1)
+    parser.add_argument("--overlap", type=int, default=0,
+                        help="shift of channel lists between clients; 0 — all clients track the same channels")
+    parser.add_argument("--tgstat-latency", type=float, default=0.0)
+    parser.add_argument("--tgstat-rps", type=float, default=1000.0)
+    parser.add_argument("--openai-latency", type=float, default=0.0)
+    parser.add_argument("--twelvelabs-latency", type=float, default=0.0)
+    parser.add_argument("--sheets-latency", type=float, default=0.0)
+    parser.add_argument("--video-clips", type=int, default=8, help="distinct video files behind post video links")
+    parser.add_argument("--video-poll", type=float, default=0.05, help="minimal video polling interval, s")
+    parser.add_argument("--json", help="write results to this file")
+    parser.add_argument("--scale", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scale:
+        run_scale(args)
+        return
+
+    # Каждый масштаб — отдельный процесс: свои кэши и честный пик памяти
+    results = []
+    for scale in [int(x) for x in args.scales.split(",")]:
+        child_args = [arg for arg in sys.argv[1:] if not arg.startswith("--scales") and arg != args.scales]
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), "--scale", str(scale)] + child_args,
+                                   capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if completed.returncode != 0:
+            print(completed.stderr, file=sys.stderr)
+            sys.exit(completed.returncode)
+        results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
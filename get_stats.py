@@ -4,37 +4,177 @@ import os
 import time
 import re
 import json
+import gzip
 import hashlib
+import heapq
+import io
+import random
+import sqlite3
+import struct
 import tempfile
-from datetime import datetime, timedelta
+from array import array
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
 from urllib.parse import urlparse
 import asyncio
-
+import atexit
+import threading
+from collections import defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
 
 import gspread
+import numpy as np
 from oauth2client.service_account import ServiceAccountCredentials
 import requests
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
 import openai
 from openai import OpenAI, RateLimitError, AuthenticationError, PermissionDeniedError
 from twelvelabs import TwelveLabs, TooManyRequestsError
-from twelvelabs.tasks import TasksRetrieveResponse
 from twelvelabs.core.api_error import ApiError
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
 
 import sys, logging
 from logging.handlers import RotatingFileHandler
 
 # ================== CONSTANTS ==================
-URL_1 = "https://api.tgstat.ru/channels/get"
-URL_2 = "https://api.tgstat.ru/channels/posts"
-URL_3 = "https://api.tgstat.ru/posts/stat"
+load_dotenv()
 
-with open('prompts/openai_sys_role.txt', 'r', encoding='utf-8') as f2:
-    OPENAI_SYS_ROLE = f2.read().strip()
-with open('prompts/pegasus_sys_role.txt', 'r', encoding='utf-8') as f3:
-    PEGASUS_SYS_ROLE = f3.read().strip()
-with open('prompts/headers.json', 'r', encoding='utf-8') as f4:
-    final_headers = json.load(f4)
+# Базовый адрес можно подменить локальным сервером для тестов
+TGSTAT_BASE_URL = os.getenv("TGSTAT_BASE_URL", "https://api.tgstat.ru").rstrip("/")
+URL_1 = f"{TGSTAT_BASE_URL}/channels/get"
+URL_2 = f"{TGSTAT_BASE_URL}/channels/posts"
+URL_3 = f"{TGSTAT_BASE_URL}/posts/stat"
+
+TGSTAT_MAX_WORKERS = int(os.getenv("TGSTAT_MAX_WORKERS", "8"))
+TGSTAT_RATE_PER_SECOND = float(os.getenv("TGSTAT_RATE_PER_SECOND", "5"))
+TGSTAT_BURST = int(os.getenv("TGSTAT_BURST", "10"))
+
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+HTTP_BACKOFF_MAX = 30.0
+HTTP_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+CACHE_DIR = os.getenv("CACHE_DIR", "cache")
+POST_STATS_CACHE_MAX_ENTRIES = int(os.getenv("POST_STATS_CACHE_MAX_ENTRIES", "50000"))
+# (возраст поста, TTL статистики): свежие посты ещё набирают просмотры
+POST_STATS_TTLS = (
+    (timedelta(days=1), timedelta(hours=2)),
+    (timedelta(days=7), timedelta(hours=12)),
+    (timedelta(days=30), timedelta(days=3)),
+)
+POST_STATS_TTL_OLD = timedelta(days=14)
+
+# Сколько постов анализировать одним запросом к OpenAI
+ANALYSIS_BATCH_SIZE = int(os.getenv("ANALYSIS_BATCH_SIZE", "10"))
+
+# Параллельная обработка строк: общий пул и отдельные лимиты на каждый API
+AI_MAX_WORKERS = int(os.getenv("AI_MAX_WORKERS", "16"))
+OPENAI_MAX_CONCURRENCY = int(os.getenv("OPENAI_MAX_CONCURRENCY", "8"))
+TWELVELABS_MAX_CONCURRENCY = int(os.getenv("TWELVELABS_MAX_CONCURRENCY", "3"))
+
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "20000"))
+VIDEO_CACHE_MAX_ENTRIES = int(os.getenv("VIDEO_CACHE_MAX_ENTRIES", "20000"))
+# Реестр каналов общий для всех клиентов; число подписчиков обновляется раз в CHANNEL_INFO_TTL_HOURS
+CHANNEL_REGISTRY_MAX_ENTRIES = int(os.getenv("CHANNEL_REGISTRY_MAX_ENTRIES", "100000"))
+CHANNEL_INFO_TTL = timedelta(hours=float(os.getenv("CHANNEL_INFO_TTL_HOURS", "24")))
+# Запас кандидатов сверх top_n при отборе по просмотрам до запроса posts/stat;
+# пусто — статистика запрашивается для всех постов канала
+STATS_PREFILTER_MARGIN = int(os.getenv("STATS_PREFILTER_MARGIN")) if os.getenv("STATS_PREFILTER_MARGIN") else None
+
+# Чем ранжировать посты внутри канала: engagement (как раньше) или recency (с затуханием по возрасту поста);
+# топ выбирается отдельно в каждом канале, поэтому нормировка между каналами на выбор не влияет
+RANKING_SCORE = os.getenv("RANKING_SCORE", "engagement")
+RECENCY_HALF_LIFE_HOURS = float(os.getenv("RECENCY_HALF_LIFE_HOURS", "72"))
+
+EXTRACTED_DATA_DIR = "extracted_data"
+# "" — обычный JSONL, "gzip" или "zstd" (нужен пакет zstandard)
+EXTRACTED_DATA_COMPRESSION = os.getenv("EXTRACTED_DATA_COMPRESSION", "")
+
+# Опрос задач индексации: интервал растёт, пока статусы не меняются
+VIDEO_POLL_MIN_INTERVAL = float(os.getenv("VIDEO_POLL_MIN_INTERVAL", "2"))
+VIDEO_POLL_MAX_INTERVAL = float(os.getenv("VIDEO_POLL_MAX_INTERVAL", "30"))
+VIDEO_POLL_MAX_ERRORS = 5
+
+# Перед индексацией видео проверяются по началу и концу файла (Range-запросы): размер, длительность
+# и отпечаток содержимого; одинаковые ролики индексируются один раз, неподходящие пропускаются
+VIDEO_PROBE_BYTES = int(os.getenv("VIDEO_PROBE_BYTES", str(256 * 1024)))
+VIDEO_MAX_BYTES = int(os.getenv("VIDEO_MAX_BYTES", str(2 * 1024 ** 3)))
+VIDEO_MIN_SECONDS = float(os.getenv("VIDEO_MIN_SECONDS", "4"))
+VIDEO_MAX_SECONDS = float(os.getenv("VIDEO_MAX_SECONDS", "7200"))
+
+# Записи в Log и ячейки Main копятся и уходят пачкой по размеру или по времени
+SHEETS_FLUSH_MAX_ITEMS = int(os.getenv("SHEETS_FLUSH_MAX_ITEMS", "50"))
+SHEETS_FLUSH_INTERVAL = float(os.getenv("SHEETS_FLUSH_INTERVAL", "10"))
+# После неудачной отправки следующая попытка откладывается, пауза удваивается до SHEETS_FLUSH_BACKOFF_MAX
+SHEETS_FLUSH_BACKOFF_MAX = float(os.getenv("SHEETS_FLUSH_BACKOFF_MAX", "300"))
+
+# Окно сбора постов: первый запуск клиента (Start) и последующие инкрементальные
+DAYS_BACK_FULL = 60
+DAYS_BACK_INCREMENTAL = 7
+# Ответы channels/posts текущего прогона лежат на диске, а не в памяти, пока их читают другие клиенты
+RUN_POSTS_CACHE_MAX_ENTRIES = int(os.getenv("RUN_POSTS_CACHE_MAX_ENTRIES", "20000"))
+RUN_POSTS_TTL = timedelta(hours=float(os.getenv("RUN_POSTS_TTL_HOURS", "6")))
+
+# Сколько клиентов обрабатывать одновременно; квоты API общие для всех
+MAX_PARALLEL_CLIENTS = int(os.getenv("MAX_PARALLEL_CLIENTS", "3"))
+SHEETS_RATE_PER_SECOND = float(os.getenv("SHEETS_RATE_PER_SECOND", "1"))
+SHEETS_BURST = int(os.getenv("SHEETS_BURST", "5"))
+# LLM_CACHE_BYPASS=1 — всегда ходить в OpenAI (ответы всё равно сохраняются в кэш)
+LLM_CACHE_BYPASS = os.getenv("LLM_CACHE_BYPASS", "") == "1"
+
+# Бюджет токенов на отдельные входы промптов; больше — сокращаем
+POST_MAX_TOKENS = int(os.getenv("POST_MAX_TOKENS", "1500"))
+TRANSCRIPT_MAX_TOKENS = int(os.getenv("TRANSCRIPT_MAX_TOKENS", "2000"))
+COMPANY_CONTEXT_MAX_TOKENS = int(os.getenv("COMPANY_CONTEXT_MAX_TOKENS", "800"))
+# Промпт больше этого отправляется, но с предупреждением в логе
+PROMPT_WARN_TOKENS = int(os.getenv("PROMPT_WARN_TOKENS", "12000"))
+# truncate — обрезать по границе слова, summarize — сжать через gpt-4o-mini (ответ кэшируется)
+PROMPT_COMPACTION = os.getenv("PROMPT_COMPACTION", "truncate")
+COMPACTION_MODEL = "gpt-4o-mini"
+COMPACTION_INPUT_MAX_TOKENS = 16000
+# Оценка без tiktoken: в среднем символов на токен для смеси русского и английского
+CHARS_PER_TOKEN = 3
+
+# Версии промптов этапов AI анализа: увеличьте при изменении промпта, чтобы строки пересчитались
+PROMPT_VERSIONS = {"analysis": 1, "rewrite": 1, "video": 1}
+# Результаты этапов по ссылке поста: пост, снова попавший в выборку, получает их без повторного анализа
+AI_RESULTS_CACHE_MAX_ENTRIES = int(os.getenv("AI_RESULTS_CACHE_MAX_ENTRIES", "100000"))
+
+# Контрольные точки клиентов сохраняются всегда, но продолжение с них включается явно
+# (RESUME_MODE=1 или --resume) для повторного запуска после сбоя; обычный запуск собирает посты заново
+RESUME_MODE = os.getenv("RESUME_MODE", "0") == "1"
+CHECKPOINT_TTL = timedelta(hours=float(os.getenv("CHECKPOINT_TTL_HOURS", "48")))
+# Готовые строки AI анализа записываются в таблицу каждые N строк или M секунд
+CHECKPOINT_FLUSH_ROWS = int(os.getenv("CHECKPOINT_FLUSH_ROWS", "20"))
+CHECKPOINT_FLUSH_INTERVAL = float(os.getenv("CHECKPOINT_FLUSH_INTERVAL", "60"))
+
+# OPENAI_BATCH_MODE=1 — запросы gpt-4o всех клиентов уходят одним пакетом в Batch API (дешевле, но ответ до 24 ч)
+OPENAI_BATCH_MODE = os.getenv("OPENAI_BATCH_MODE", "") == "1"
+OPENAI_BATCH_PURPOSES = ("analysis", "analysis_batch", "rewrite", "video_suggestion")
+OPENAI_BATCH_MAX_REQUESTS = 50000
+OPENAI_BATCH_POLL_INTERVAL = float(os.getenv("OPENAI_BATCH_POLL_INTERVAL", "60"))
+OPENAI_BATCH_TIMEOUT = timedelta(hours=26)
+
+# Метрики прогона: *.prom — textfile для node_exporter, иначе JSON; пусто — только итог в логе
+METRICS_EXPORT_PATH = os.getenv("METRICS_EXPORT_PATH", "")
+METRICS_PREFIX = "tgstat_"
+METRICS_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900)
+METRICS_LOG_TOP = 40
+
+OPENAI_SYS_ROLE_FILE = 'prompts/openai_sys_role.txt'
+PEGASUS_SYS_ROLE_FILE = 'prompts/pegasus_sys_role.txt'
+HEADERS_FILE = 'prompts/headers.json'
 
 ADMIN_SPREADSHEET_NAME: str = "Sellebra TGstat (admin)"
 CHANNELS: str = 'Каналы'
@@ -67,21 +207,246 @@ if not logger.handlers:
     logger.addHandler(sh)
 logger.propagate = False
 
+# ================== METRICS ==================
+class Metrics:
+    """Process-wide counters and duration histograms keyed by name and labels"""
+
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = buckets
+        self._counters = defaultdict(float)
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+    def inc(self, name: str, value=1, **labels):
+        with self._lock:
+            self._counters[self._key(name, labels)] += value
+
+    def observe(self, name: str, seconds: float, **labels):
+        bucket = next((i for i, b in enumerate(self.buckets) if seconds <= b), len(self.buckets))
+        with self._lock:
+            timing = self._timings.setdefault(self._key(name, labels), {
+                "counts": [0] * (len(self.buckets) + 1), "count": 0, "sum": 0.0, "max": 0.0})
+            timing["counts"][bucket] += 1
+            timing["count"] += 1
+            timing["sum"] += seconds
+            timing["max"] = max(timing["max"], seconds)
+
+    @contextmanager
+    def span(self, name: str, **labels):
+        """Time the block into histogram `name`, also when it raises"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def _snapshot(self):
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {key: dict(timing, counts=list(timing["counts"])) for key, timing in self._timings.items()}
+        return counters, timings
+
+    def log_summary(self, top=METRICS_LOG_TOP):
+        """Log counters and the `top` timings with the largest total time"""
+        counters, timings = self._snapshot()
+        for (name, labels), value in sorted(counters.items()):
+            logger.info(f"🔢 {name}{_format_labels(labels)}: {value:g}")
+        by_total = sorted(timings.items(), key=lambda item: item[1]["sum"], reverse=True)
+        for (name, labels), timing in by_total[:top]:
+            logger.info(f"⏱ {name}{_format_labels(labels)}: {timing['count']} раз, всего {timing['sum']:.1f} с, "
+                        f"в среднем {timing['sum'] / timing['count']:.2f} с, максимум {timing['max']:.2f} с")
+        if len(by_total) > top:
+            logger.info(f"⏱ ... и ещё {len(by_total) - top} рядов, полный список — в METRICS_EXPORT_PATH")
+
+    def export(self, path: str):
+        """Atomically write metrics to path: Prometheus text format for *.prom, JSON otherwise"""
+        counters, timings = self._snapshot()
+        if path.endswith(".prom"):
+            text = self._prometheus(counters, timings)
+        else:
+            text = json.dumps({
+                "generated_at": datetime.now().isoformat(),
+                "counters": [{"name": name, "labels": dict(labels), "value": value}
+                             for (name, labels), value in sorted(counters.items())],
+                "timings": [{"name": name, "labels": dict(labels), "count": t["count"],
+                             "sum": round(t["sum"], 3), "max": round(t["max"], 3),
+                             "buckets": dict(zip([str(b) for b in self.buckets] + ["+Inf"], t["counts"]))}
+                            for (name, labels), t in sorted(timings.items())],
+            }, ensure_ascii=False, indent=2)
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        # node_exporter не должен увидеть недописанный файл
+        with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp", delete=False, encoding="utf-8") as f:
+            f.write(text)
+        os.replace(f.name, path)
+
+    def _prometheus(self, counters, timings) -> str:
+        lines = []
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} counter")
+            for (series, labels), value in sorted(counters.items()):
+                if series == name:
+                    lines.append(f"{METRICS_PREFIX}{name}{_format_labels(labels, quote=True)} {value:g}")
+        for name in sorted({name for name, _ in timings}):
+            lines.append(f"# TYPE {METRICS_PREFIX}{name} histogram")
+            for (series, labels), timing in sorted(timings.items()):
+                if series != name:
+                    continue
+                cumulative = 0
+                for le, count in zip([str(b) for b in self.buckets] + ["+Inf"], timing["counts"]):
+                    cumulative += count
+                    lines.append(f"{METRICS_PREFIX}{name}_bucket{_format_labels(labels + (('le', le),), quote=True)} {cumulative}")
+                lines.append(f"{METRICS_PREFIX}{name}_sum{_format_labels(labels, quote=True)} {timing['sum']:.6f}")
+                lines.append(f"{METRICS_PREFIX}{name}_count{_format_labels(labels, quote=True)} {timing['count']}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: tuple, quote=False) -> str:
+    if not labels:
+        return ""
+    if quote:
+        escape = lambda v: v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels) + "}"
+    return "{" + ", ".join(f"{k}={v}" for k, v in labels) + "}"
+
+
+metrics = Metrics()
+
+# ================== CONCURRENCY ==================
+class TokenBucket:
+    """Thread-safe token bucket: `rate` requests per second with bursts up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+# Квота TGStat считается на API-ключ, поэтому лимитер один на весь процесс
+tgstat_limiter = TokenBucket(TGSTAT_RATE_PER_SECOND, TGSTAT_BURST)
+openai_semaphore = threading.BoundedSemaphore(OPENAI_MAX_CONCURRENCY)
+twelvelabs_semaphore = threading.BoundedSemaphore(TWELVELABS_MAX_CONCURRENCY)
+# Квота Google Sheets общая для всех клиентов, которые обрабатываются параллельно
+sheets_limiter = TokenBucket(SHEETS_RATE_PER_SECOND, SHEETS_BURST)
+
+
+class RateLimitedHTTPClient(gspread.HTTPClient):
+    """gspread HTTP client that passes every Sheets API request through sheets_limiter"""
+
+    def request(self, method, *args, **kwargs):
+        sheets_limiter.acquire()
+        metrics.inc("sheets_requests_total", method=method)
+        try:
+            with metrics.span("sheets_request_seconds", method=method):
+                return super().request(method, *args, **kwargs)
+        except gspread.exceptions.APIError as e:
+            metrics.inc("sheets_errors_total", method=method, status=e.response.status_code)
+            raise
+
+
+def run_concurrently(func, items, max_workers=TGSTAT_MAX_WORKERS):
+    """Apply func to items in a thread pool, return (result, error) pairs in input order"""
+    items = list(items)
+    if not items:
+        return []
+
+    def safe_call(item):
+        try:
+            return func(item), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(safe_call, items))
+
+
+class SingleFlight:
+    """Run-scoped request coalescing: the first caller of a key runs func, concurrent and later callers get its result.
+
+    Failed calls are not remembered, so a later caller retries them. With remember=False results
+    are dropped as soon as the call finishes, and only concurrent callers share them.
+    """
+
+    def __init__(self, remember=True):
+        self.remember = remember
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = self._futures[key] = Future()
+        if owner:
+            try:
+                result = func()
+            except Exception as e:
+                with self._lock:
+                    del self._futures[key]
+                future.set_exception(e)
+            else:
+                if not self.remember:
+                    with self._lock:
+                        del self._futures[key]
+                future.set_result(result)
+        return future.result()
+
+    def clear(self):
+        with self._lock:
+            self._futures.clear()
+
+
+def chain_future(future: Future, func, executor) -> Future:
+    """Run func(future.result()) on executor once future is done, without blocking a worker while waiting"""
+    result = Future()
+
+    def copy_result(inner: Future):
+        if inner.cancelled():
+            result.cancel()
+        elif inner.exception() is not None:
+            result.set_exception(inner.exception())
+        else:
+            result.set_result(inner.result())
+
+    def on_done(f: Future):
+        if f.exception() is not None:
+            result.set_exception(f.exception())
+            return
+        try:
+            executor.submit(func, f.result()).add_done_callback(copy_result)
+        except RuntimeError as e:
+            # пул уже остановлен из-за ошибки в другой ветке
+            result.set_exception(e)
+
+    future.add_done_callback(on_done)
+    return result
+
+
 # ================== AUTH ==================
-load_dotenv()
 TGSTAT_API_KEY = os.getenv("TGSTAT_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 openai.api_key = OPENAI_API_KEY
 PEGASUS_API_KEY = os.getenv("PEGASUS_API_KEY")
 
-client1 = OpenAI(api_key=OPENAI_API_KEY)
-client2 = TwelveLabs(api_key=PEGASUS_API_KEY)
-
-scope = ['https://spreadsheets.google.com/feeds',
-         'https://www.googleapis.com/auth/drive']
-creds = ServiceAccountCredentials.from_json_keyfile_name('creds.json', scope)
-gs_client = gspread.authorize(creds)
-
 def get_or_create_worksheet(spreadsheet_name, title, rows=100, cols=20):
     try:
         return spreadsheet_name.worksheet(title)
@@ -89,10 +454,536 @@ def get_or_create_worksheet(spreadsheet_name, title, rows=100, cols=20):
         logger.warning(f"⚠️ Лист '{title}' не найден, создаю новый...")
         return spreadsheet_name.add_worksheet(title=title, rows=rows, cols=cols)
 
+
+def _read_text(path: str) -> str:
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read().strip()
+
+
+def _read_json(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
 # ================== GLOBAL VARIABLES ==================   
-admin_spreadsheet = gs_client.open(ADMIN_SPREADSHEET_NAME)
-admin_main = get_or_create_worksheet(admin_spreadsheet, MAIN)
-admin_log = get_or_create_worksheet(admin_spreadsheet, LOG)
+class Context:
+    """API clients, prompts and admin worksheets, created on first use.
+
+    Importing the module only loads .env and opens the log file; clients, prompt files and sheets
+    are touched on first access. Tests inject fakes with ctx.override(openai=..., ...).
+    """
+
+    def __init__(self):
+        self._values = {}
+        self._name_locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def _get(self, name: str, factory):
+        if name in self._values:
+            return self._values[name]
+        # Фабрики ходят в сеть, поэтому блокируется только своё имя, а не весь контекст
+        with self._lock:
+            name_lock = self._name_locks[name]
+        with name_lock:
+            if name not in self._values:
+                value = factory()
+                with self._lock:
+                    # override, сделанный во время создания, важнее
+                    self._values.setdefault(name, value)
+            return self._values[name]
+
+    def override(self, **values):
+        with self._lock:
+            self._values.update(values)
+
+    @property
+    def openai(self) -> OpenAI:
+        # OPENAI_BASE_URL позволяет направить запросы на локальный фейковый сервер
+        return self._get("openai", lambda: OpenAI(api_key=OPENAI_API_KEY, base_url=os.getenv("OPENAI_BASE_URL") or None))
+
+    @property
+    def twelvelabs(self) -> TwelveLabs:
+        return self._get("twelvelabs", lambda: TwelveLabs(api_key=PEGASUS_API_KEY))
+
+    @property
+    def gs_client(self) -> gspread.Client:
+        def authorize():
+            scope = ['https://spreadsheets.google.com/feeds',
+                     'https://www.googleapis.com/auth/drive']
+            creds = ServiceAccountCredentials.from_json_keyfile_name('creds.json', scope)
+            return gspread.authorize(creds, http_client=RateLimitedHTTPClient)
+        return self._get("gs_client", authorize)
+
+    @property
+    def admin_spreadsheet(self):
+        return self._get("admin_spreadsheet", lambda: self.gs_client.open(ADMIN_SPREADSHEET_NAME))
+
+    @property
+    def admin_main(self):
+        return self._get("admin_main", lambda: get_or_create_worksheet(self.admin_spreadsheet, MAIN))
+
+    @property
+    def admin_log(self):
+        return self._get("admin_log", lambda: get_or_create_worksheet(self.admin_spreadsheet, LOG))
+
+    @property
+    def openai_sys_role(self) -> str:
+        return self._get("openai_sys_role", lambda: _read_text(OPENAI_SYS_ROLE_FILE))
+
+    @property
+    def pegasus_sys_role(self) -> str:
+        return self._get("pegasus_sys_role", lambda: _read_text(PEGASUS_SYS_ROLE_FILE))
+
+    @property
+    def final_headers(self):
+        return self._get("final_headers", lambda: _read_json(HEADERS_FILE))
+
+
+ctx = Context()
+
+
+class SheetWriteBuffer:
+    """Coalesces admin Log rows and Main cell updates into batched Sheets API calls"""
+
+    def __init__(self, get_log_worksheet, get_main_worksheet, max_items=SHEETS_FLUSH_MAX_ITEMS, max_delay=SHEETS_FLUSH_INTERVAL):
+        # Листы запрашиваются только при первой отправке
+        self.get_log_worksheet = get_log_worksheet
+        self.get_main_worksheet = get_main_worksheet
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self._log_rows = []
+        self._cells = {}
+        self._timer = None
+        self._failures = 0
+        self._retry_at = 0.0
+        self._lock = threading.RLock()
+
+    def log(self, company_id, company_name, message):
+        """Same row as admin_log.insert_row([...], 2): newest entries stay on top"""
+        with self._lock:
+            self._log_rows.append([company_id, company_name, message, datetime.today().isoformat()])
+            self._schedule()
+
+    def update_cell(self, row: int, col: int, value):
+        with self._lock:
+            # для одной ячейки важно только последнее значение
+            self._cells[(row, col)] = value
+            self._schedule()
+
+    def _schedule(self):
+        # Полный буфер уходит сразу, но не раньше, чем закончится пауза после ошибки
+        full = len(self._log_rows) + len(self._cells) >= self.max_items
+        delay = max(self._retry_at - time.monotonic(), 0 if full else self.max_delay)
+        if delay <= 0:
+            self.flush()
+        elif self._timer is None:
+            self._start_timer(delay)
+
+    def _start_timer(self, delay: float):
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            log_rows, self._log_rows = self._log_rows, []
+            cells, self._cells = self._cells, {}
+            # Log и Main пишутся отдельно: в буфер возвращается только то, что не записалось
+            errors = []
+            if log_rows:
+                try:
+                    self.get_log_worksheet().insert_rows(log_rows[::-1], row=2)
+                except Exception as e:
+                    errors.append(e)
+                    self._log_rows[:0] = log_rows
+            if cells:
+                try:
+                    self.get_main_worksheet().batch_update(
+                        [{"range": gspread.utils.rowcol_to_a1(row, col), "values": [[value]]}
+                         for (row, col), value in cells.items()],
+                        value_input_option="USER_ENTERED")
+                except Exception as e:
+                    errors.append(e)
+                    self._cells = {**cells, **self._cells}
+            if errors:
+                # Повторяем по таймеру с растущей паузой
+                self._failures += 1
+                delay = min(SHEETS_FLUSH_BACKOFF_MAX, self.max_delay * 2 ** (self._failures - 1))
+                self._retry_at = time.monotonic() + delay
+                logger.warning(f"⚠️ Не удалось записать в таблицу администратора: {errors[0]}, повтор через {delay:.1f} с")
+                self._start_timer(delay)
+            else:
+                self._failures = 0
+                self._retry_at = 0.0
+
+
+sheet_writer = SheetWriteBuffer(lambda: ctx.admin_log, lambda: ctx.admin_main)
+atexit.register(sheet_writer.flush)
+
+# ================== HTTP ==================
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(url: str) -> requests.Session:
+    """Return the pooled keep-alive session for the url's host"""
+    host = urlparse(url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+    return session
+
+
+def _endpoint(url: str) -> str:
+    parsed = urlparse(url)
+    return f"{parsed.netloc}{parsed.path}"
+
+
+def _retry_delay(attempt: int, response=None) -> float:
+    """Retry-After if the server sent one, otherwise full-jitter exponential backoff"""
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return min(HTTP_BACKOFF_MAX, max(0.0, float(retry_after)))
+        except ValueError:
+            try:
+                delta = parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)
+                return min(HTTP_BACKOFF_MAX, max(0.0, delta.total_seconds()))
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** attempt))
+
+
+def http_get(url: str, params=None, timeout=15, stream=False, limiter=None, headers=None) -> requests.Response:
+    """GET through the pooled session, retrying connection errors, 429 and 5xx"""
+    session = get_session(url)
+    endpoint = _endpoint(url)
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        if limiter:
+            limiter.acquire()
+        start = time.monotonic()
+        try:
+            response = session.get(url, params=params, timeout=timeout, stream=stream, headers=headers)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.observe("http_request_seconds", time.monotonic() - start, endpoint=endpoint)
+            metrics.inc("http_requests_total", endpoint=endpoint, status=type(e).__name__)
+            if attempt == HTTP_MAX_RETRIES:
+                raise
+            metrics.inc("http_retries_total", endpoint=endpoint)
+            delay = _retry_delay(attempt)
+            logger.warning(f"⚠️ {urlparse(url).path}: {e}, повтор через {delay:.1f} с")
+            time.sleep(delay)
+            continue
+        metrics.observe("http_request_seconds", time.monotonic() - start, endpoint=endpoint)
+        metrics.inc("http_requests_total", endpoint=endpoint, status=response.status_code)
+        if response.status_code in HTTP_RETRY_STATUSES and attempt < HTTP_MAX_RETRIES:
+            metrics.inc("http_retries_total", endpoint=endpoint)
+            delay = _retry_delay(attempt, response)
+            logger.warning(f"⚠️ {urlparse(url).path}: HTTP {response.status_code}, повтор через {delay:.1f} с")
+            response.close()
+            time.sleep(delay)
+            continue
+        return response
+
+
+# ================== CACHE ==================
+class SqliteCache:
+    """Persistent JSON key-value cache with per-entry TTL, LRU eviction and hit/miss counters.
+
+    max_entries=None disables eviction for state that must not be lost. Access times of hits are
+    written in batches, and entries are evicted in batches once the table outgrows max_entries.
+    """
+
+    TOUCH_BATCH = 200
+
+    def __init__(self, path: str, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        # Вытесняем с запасом, чтобы не считать и не чистить таблицу на каждой записи
+        self.evict_batch = max(1, max_entries // 20) if max_entries else 0
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._count = 0
+        self._touched = {}
+        self._lock = threading.Lock()
+        atexit.register(self.flush_access_times)
+
+    def _connect(self):
+        # Файл открывается при первом обращении, а не при импорте
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL, accessed_at REAL NOT NULL)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache(accessed_at)")
+            self._count = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        return self._conn
+
+    def _write_access_times(self, conn):
+        if self._touched:
+            conn.executemany("UPDATE cache SET accessed_at = ? WHERE key = ?",
+                             [(accessed_at, key) for key, accessed_at in self._touched.items()])
+            self._touched.clear()
+
+    def flush_access_times(self):
+        with self._lock:
+            if self._conn is not None and self._touched:
+                self._write_access_times(self._conn)
+                self._conn.commit()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                self.misses += 1
+                return None
+            # Время обращения нужно только для вытеснения, пишем его пачками
+            self._touched[key] = now
+            if len(self._touched) >= self.TOUCH_BATCH:
+                self._write_access_times(conn)
+                conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value, ttl: timedelta = None):
+        now = time.time()
+        expires_at = now + ttl.total_seconds() if ttl else None
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at, now))
+            self._touched.pop(key, None)
+            # счётчик — верхняя оценка (перезапись ключа тоже его увеличивает), точно пересчитываем перед вытеснением
+            self._count += 1
+            if self.max_entries and self._count > self.max_entries + self.evict_batch:
+                self._write_access_times(conn)
+                self._count = conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+                if self._count > self.max_entries:
+                    conn.execute(
+                        "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)",
+                        (self._count - self.max_entries,))
+                    self._count = self.max_entries
+            conn.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            conn.commit()
+            self._touched.pop(key, None)
+
+    def log_stats(self, name: str):
+        total = self.hits + self.misses
+        if total:
+            logger.info(f"🗄 Кэш {name}: {self.hits} попаданий, {self.misses} промахов ({self.hits / total:.0%})")
+
+
+post_stats_cache = SqliteCache(os.path.join(CACHE_DIR, "post_stats.sqlite"), POST_STATS_CACHE_MAX_ENTRIES)
+llm_cache = SqliteCache(os.path.join(CACHE_DIR, "llm.sqlite"), LLM_CACHE_MAX_ENTRIES)
+# URL видео -> {index_id, video_id, summary, prompt}
+video_cache = SqliteCache(os.path.join(CACHE_DIR, "videos.sqlite"), VIDEO_CACHE_MAX_ENTRIES)
+# "username:<name>" / "id:<TGStat id>" / "invite:<hash>" -> результат get_channel_info
+channel_registry = SqliteCache(os.path.join(CACHE_DIR, "channels.sqlite"), CHANNEL_REGISTRY_MAX_ENTRIES)
+# "<run_id>:<channel_id>:<days>" -> ответ channels/posts текущего прогона (см. SharedFetches)
+run_posts_cache = SqliteCache(os.path.join(CACHE_DIR, "run_posts.sqlite"), RUN_POSTS_CACHE_MAX_ENTRIES)
+# "<company_id>:<post_link>" -> {fingerprint, values} последнего AI анализа поста
+ai_results_cache = SqliteCache(os.path.join(CACHE_DIR, "ai_results.sqlite"), AI_RESULTS_CACHE_MAX_ENTRIES)
+
+
+# Состояние инкрементальных запусков не вытесняется: потеря записи означает
+# полную перевыборку канала или повторную вставку уже добавленных постов
+# "<company_id>:<channel_id>" -> {date, id} самого нового оценённого поста
+watermarks_store = SqliteCache(os.path.join(CACHE_DIR, "watermarks.sqlite"), None)
+# "<company_id>:<post_link>" -> дата попадания поста в Рекомендации
+seen_posts_store = SqliteCache(os.path.join(CACHE_DIR, "seen_posts.sqlite"), None)
+
+
+# company_id -> состояние незавершённого process_table (см. Checkpoint)
+checkpoints_store = SqliteCache(os.path.join(CACHE_DIR, "checkpoints.sqlite"), 10000)
+
+
+class Checkpoint:
+    """Progress of one client's process_table, kept locally until the client finishes.
+
+    Stages: "posts" — rows are selected, "inserting" — rows are being inserted into Рекомендации,
+    "inserted" — rows are in Рекомендации, "ai" — some rows are analyzed and written. Resuming assumes Рекомендации was not edited in between.
+    """
+
+    def __init__(self, company_id: int):
+        self.key = str(company_id)
+        self.state = (checkpoints_store.get(self.key) if RESUME_MODE else None) or {}
+
+    @property
+    def stage(self):
+        return self.state.get("stage")
+
+    def save(self, stage: str, **state):
+        self.state.update(state, stage=stage, updated_at=datetime.now().isoformat())
+        checkpoints_store.set(self.key, self.state, CHECKPOINT_TTL)
+
+    def clear(self):
+        checkpoints_store.delete(self.key)
+        self.state = {}
+
+
+def _post_position(post) -> tuple:
+    try:
+        return int(post.get("date") or 0), int(post.get("id") or 0)
+    except (TypeError, ValueError):
+        return 0, 0
+
+
+class DeltaState:
+    """Channel watermarks and already processed posts of one company.
+
+    In incremental mode only posts newer than the watermark and not yet in Рекомендации are kept.
+    New watermarks are written by commit() only after the run succeeded.
+    """
+
+    def __init__(self, company_id: int, incremental: bool):
+        self.company_id = company_id
+        self.incremental = incremental
+        self._watermarks = {}
+        self._processed_links = []
+
+    def since(self, channel_id):
+        """Timestamp of the newest post seen in the channel, None for a full window"""
+        if not self.incremental:
+            return None
+        watermark = watermarks_store.get(f"{self.company_id}:{channel_id}")
+        return watermark["date"] if watermark else None
+
+    def filter_new(self, channel_id, posts):
+        if not self.incremental:
+            return posts
+
+        watermark = watermarks_store.get(f"{self.company_id}:{channel_id}")
+        last_position = (watermark["date"], watermark["id"]) if watermark else (0, 0)
+        return [post for post in posts
+                if _post_position(post) > last_position
+                and seen_posts_store.get(f"{self.company_id}:{post.get('link', '')}") is None]
+
+    def advance(self, channel_id, scored_posts, unscored_posts=()):
+        """Move the channel watermark to the newest scored post older than every unscored candidate.
+
+        Candidates without stats (failed posts/stat, cut by the prefilter) stay above the
+        watermark and are considered again by the next run.
+        """
+        limit = min((_post_position(post) for post in unscored_posts), default=None)
+        positions = [position for position in map(_post_position, scored_posts) if limit is None or position < limit]
+        if positions:
+            self._watermarks[channel_id] = max(max(positions), self._watermarks.get(channel_id, (0, 0)))
+
+    def pending_watermarks(self) -> dict:
+        return {str(channel_id): list(position) for channel_id, position in self._watermarks.items()}
+
+    def restore_watermarks(self, watermarks: dict):
+        """Watermarks from pending_watermarks() of an interrupted run"""
+        for channel_id, position in watermarks.items():
+            self._watermarks[channel_id] = max(tuple(position), self._watermarks.get(channel_id, (0, 0)))
+
+    def mark_processed(self, post_links):
+        self._processed_links.extend(link for link in post_links if link)
+
+    def commit(self):
+        for channel_id, (date, post_id) in self._watermarks.items():
+            key = f"{self.company_id}:{channel_id}"
+            watermark = watermarks_store.get(key)
+            if not watermark or (date, post_id) > (watermark["date"], watermark["id"]):
+                watermarks_store.set(key, {"date": date, "id": post_id})
+        for link in self._processed_links:
+            seen_posts_store.set(f"{self.company_id}:{link}", datetime.today().isoformat())
+        self._watermarks.clear()
+        self._processed_links.clear()
+
+
+def post_stats_ttl(post_date) -> timedelta:
+    """TTL of cached stats depending on the post age"""
+    try:
+        age = datetime.now() - datetime.fromtimestamp(int(post_date))
+    except (TypeError, ValueError, OverflowError, OSError):
+        return POST_STATS_TTLS[0][1]
+    for max_age, ttl in POST_STATS_TTLS:
+        if age <= max_age:
+            return ttl
+    return POST_STATS_TTL_OLD
+
+
+# ================== STORAGE ==================
+class JsonlWriter:
+    """Appends compact JSON Lines records to a file, optionally gzip/zstd-compressed.
+
+    Every append() is written as a separate gzip member / zstd frame, so a crash
+    loses at most the batch being written.
+    """
+
+    SUFFIXES = {"": "", "gzip": ".gz", "zstd": ".zst"}
+
+    def __init__(self, path: str, compression: str = ""):
+        if compression == "zstd" and zstandard is None:
+            logger.warning("⚠️ Пакет zstandard не установлен, сжимаем gzip")
+            compression = "gzip"
+        if compression not in self.SUFFIXES:
+            raise ValueError(f"Неизвестный тип сжатия: {compression}")
+        self.compression = compression
+        self.path = path + self.SUFFIXES[compression]
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+
+    def append(self, records):
+        data = "".join(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+                       for record in records).encode("utf-8")
+        if not data:
+            return
+        if self.compression == "gzip":
+            data = gzip.compress(data)
+        elif self.compression == "zstd":
+            data = zstandard.ZstdCompressor().compress(data)
+        with open(self.path, "ab") as f:
+            f.write(data)
+
+
+def iter_jsonl(path: str):
+    """Lazily yield records from a .jsonl, .jsonl.gz or .jsonl.zst file"""
+    if path.endswith(".gz"):
+        f = gzip.open(path, "rt", encoding="utf-8")
+    elif path.endswith(".zst"):
+        if zstandard is None:
+            raise Exception("Для чтения .zst нужен пакет zstandard")
+        reader = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True)
+        f = io.TextIOWrapper(reader, encoding="utf-8")
+    else:
+        f = open(path, "r", encoding="utf-8")
+    # последний блок мог не дописаться при падении процесса
+    truncated_errors = (EOFError, zstandard.ZstdError) if zstandard else (EOFError,)
+    with f:
+        try:
+            for line in f:
+                if not line.endswith("\n"):
+                    raise EOFError
+                if line.strip():
+                    yield json.loads(line)
+        except truncated_errors:
+            logger.warning(f"⚠️ Файл {path} обрезан, прочитаны только целые записи")
+
+
+def extracted_data_dir(company_id: int, run_id: str) -> str:
+    """extracted_data/<company_id>/<run_id>: clients and runs never overwrite each other"""
+    return os.path.join(EXTRACTED_DATA_DIR, str(company_id), run_id)
+
 
 # ================== FUNCTIONS ==================
 def get_channel_info(channel_id):
@@ -102,7 +993,7 @@ def get_channel_info(channel_id):
         'channelId': channel_id
     }
 
-    response = requests.get(url, params=params, timeout=15).json()
+    response = http_get(url, params=params, timeout=15, limiter=tgstat_limiter).json()
     if response.get("status", "") == "error":
         raise Exception(response['error'])
     ch = response.get("response", {})
@@ -114,8 +1005,91 @@ def get_channel_info(channel_id):
     }
 
 
-def extract_channels_from_sheet(channels_worksheet):
-    all_data = channels_worksheet.get_all_values()
+def channel_key(link: str) -> str:
+    """Registry key of a channel link: t.me/x, https://t.me/s/x/123, @x and x share one key.
+
+    Telegram ids (t.me/c/<id>/123, -100<id>) map to tg:<id>, TGStat ids to id:<id>.
+    """
+    value = link.strip()
+    value = re.sub(r"^(https?://)?(www\.)?(t\.me|telegram\.me|telegram\.dog)/", "", value, flags=re.IGNORECASE)
+    value = value.split("?")[0].strip("/")
+    if value.startswith("+") or value.lower().startswith("joinchat/"):
+        # у приглашений регистр значим
+        return "invite:" + value.split("/")[-1].lstrip("+")
+    if value.lower().startswith("s/"):
+        value = value[2:]
+    if value.lower().startswith("c/"):
+        # приватная ссылка t.me/c/<id>/<post> — это Telegram id, а не username "c"
+        return f"tg:{value.split('/')[1]}"
+    value = value.split("/")[0].lstrip("@")
+    if re.fullmatch(r"-\d+", value):
+        # Telegram id в формате Bot API: -100<id> у каналов
+        return f"tg:{value[4:] if value.startswith('-100') else value[1:]}"
+    if value.isdigit():
+        # числовой channelId в TGStat — это id самого TGStat, храним отдельно от Telegram id
+        return f"id:{value}"
+    return f"username:{value.lower()}"
+
+
+def _channel_aliases(info) -> set:
+    aliases = set()
+    if info.get("ID"):
+        aliases.add(f"id:{info['ID']}")
+    if info.get("link", "").startswith("https://t.me/"):
+        aliases.add(channel_key(info["link"]))
+    return aliases
+
+
+def resolve_channels(links):
+    """Channel info for links in input order as (info, error) pairs.
+
+    Registry hits are local; misses are resolved concurrently and stored under every alias of the channel.
+    """
+    keys = [channel_key(link) for link in links]
+    results = {}
+    misses = {}
+    for link, key in zip(links, keys):
+        if key in results or key in misses:
+            continue
+        cached = channel_registry.get(key)
+        if cached is not None:
+            results[key] = (cached, None)
+        else:
+            misses[key] = link.strip()
+
+    if misses:
+        logger.info(f"🔎 Каналов в реестре: {len(results)}, запрашиваем в TGStat: {len(misses)}")
+    for (key, link), (info, error) in zip(misses.items(), run_concurrently(lambda item: shared_fetches.channel_info(*item), misses.items())):
+        results[key] = (info, error)
+        if info:
+            for alias in {key} | _channel_aliases(info):
+                channel_registry.set(alias, info, CHANNEL_INFO_TTL)
+    return [results[key] for key in keys]
+
+
+class SheetModel:
+    """Worksheet values kept in memory: read once, written back with a single update call"""
+
+    def __init__(self, worksheet):
+        self.worksheet = worksheet
+        self.values = worksheet.get_all_values()
+
+    def write(self, values):
+        """Replace the sheet contents; cells left over from the old values are blanked in the same call"""
+        values = [list(row) for row in values]
+        width = max(len(row) for row in values + self.values + [[]])
+        padded = [row + [""] * (width - len(row)) for row in values]
+        padded += [[""] * width for _ in range(len(self.values) - len(values))]
+        # update, в отличие от append_rows, не расширяет лист сам
+        if len(padded) > self.worksheet.row_count:
+            self.worksheet.add_rows(len(padded) - self.worksheet.row_count)
+        if width > self.worksheet.col_count:
+            self.worksheet.add_cols(width - self.worksheet.col_count)
+        self.worksheet.update(range_name="A1", values=padded, value_input_option='RAW')
+        self.values = values
+
+
+def extract_channels_from_sheet(all_data):
     headers = all_data[0]
     data = all_data[1:]
     link_col_index = headers.index("link") # TODO: make it a variable
@@ -128,18 +1102,19 @@ def extract_channels_from_sheet(channels_worksheet):
     return channels_list
 
 
-def save_to_sheet_channels(data, worksheet):
+def save_to_sheet_channels(data, sheet: SheetModel):
     header = ["Название канала", "link", "ID", "Количество подписчиков"]
     rows = [[ch['Название канала'], ch['link'], ch['ID'], ch["Количество подписчиков"]] for ch in data]
-    worksheet.clear()
-    worksheet.append_row(header, value_input_option='RAW')
-    worksheet.append_rows(rows, value_input_option='RAW')
+    sheet.write([header] + rows)
 
 
-def get_top_posts(channel_id, days_back, limit=50):
+def get_top_posts(channel_id, days_back, limit=50, since=None):
     url = URL_2
     date_to = datetime.today()
     date_from = date_to - timedelta(days=days_back)
+    if since:
+        # Посты до водяного знака уже обработаны; точнее отсекаем по дате поста после ответа
+        date_from = max(date_from, datetime.fromtimestamp(since))
     params = {
         'token': TGSTAT_API_KEY,
         'channelId': channel_id,
@@ -148,13 +1123,73 @@ def get_top_posts(channel_id, days_back, limit=50):
         'endDate': date_to.strftime('%Y-%m-%d'),
         'extended': 1
     }
-    response = requests.get(url, params=params, timeout=15)
+    response = http_get(url, params=params, timeout=15, limiter=tgstat_limiter)
     try:
         return response.json().get("response", {}).get("items", [])
     except Exception as e:
         raise Exception(f"Ошибка парсинга JSON для channel {channel_id}: {e}")
 
 
+class SharedFetches:
+    """channels/get, channels/posts and posts/stat shared by all clients of one run.
+
+    Each channel is fetched once with the widest window of the run and sliced per client.
+    Only channel infos stay in memory: posts of a run started with start_run() are kept in
+    run_posts_cache on disk, and stats rely on post_stats_cache. Outside a run (bench,
+    direct process_table calls) only concurrent identical requests are merged.
+    """
+
+    def __init__(self):
+        self.days_back = 0
+        self.run_id = None
+        self._channels = SingleFlight()
+        self._posts = SingleFlight(remember=False)
+        self._stats = SingleFlight(remember=False)
+
+    def start_run(self, days_back: int):
+        self.clear()
+        self.days_back = days_back
+        self.run_id = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+
+    def clear(self):
+        self.days_back = 0
+        self.run_id = None
+        self._channels.clear()
+
+    def channel_info(self, key, link):
+        return self._channels.do(key, lambda: get_channel_info(link))
+
+    def posts(self, channel_id, days_back, since=None):
+        window = max(days_back, self.days_back)
+        # вне общего прогона окно ни с кем не делится, и водяной знак сужает сам запрос
+        fetch_since = since if self.run_id is None else None
+        posts = self._posts.do((channel_id, window, fetch_since), lambda: self._fetch_posts(channel_id, window, fetch_since))
+        if window == days_back and not since:
+            return list(posts)
+        # та же граница, что get_top_posts передаёт в startDate: начало дня
+        date_from = datetime.today() - timedelta(days=days_back)
+        if since:
+            date_from = max(date_from, datetime.fromtimestamp(since))
+        start = date_from.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        return [post for post in posts if not post.get("date") or int(post["date"]) >= start]
+
+    def _fetch_posts(self, channel_id, window, since=None):
+        if self.run_id is None:
+            return get_top_posts(channel_id, window, since=since)
+        key = f"{self.run_id}:{channel_id}:{window}"
+        posts = run_posts_cache.get(key)
+        if posts is None:
+            posts = get_top_posts(channel_id, window)
+            run_posts_cache.set(key, posts, RUN_POSTS_TTL)
+        return posts
+
+    def post_stats(self, post_link, post_date=None):
+        return self._stats.do(post_link, lambda: fetch_post_stats(post_link, post_date))
+
+
+shared_fetches = SharedFetches()
+
+
 def transform_to_normal_date(timestamp):
     try:
         dt = datetime.fromtimestamp(int(timestamp))
@@ -163,155 +1198,486 @@ def transform_to_normal_date(timestamp):
         return "", ""
 
 
-def fetch_post_stats(post_link):
+def fetch_post_stats(post_link, post_date=None):
     url = URL_3
     parsed_url = urlparse(post_link)
     path_parts = parsed_url.path.split('/')
     if len(path_parts) < 3:
         return None
+    cached = post_stats_cache.get(post_link)
+    if cached is not None:
+        return cached
     params = {"token": TGSTAT_API_KEY, "postId": post_link}
     try:
-        response = requests.get(url, params=params, timeout=15)
+        response = http_get(url, params=params, timeout=15, limiter=tgstat_limiter)
         data = response.json()
         if data.get("status") == "ok":
+            post_stats_cache.set(post_link, data["response"], post_stats_ttl(post_date))
             return data["response"]
     except Exception as e:
         raise Exception(f"Exception for post {post_link}: {str(e)}")
 
 
 def calculate_engagement(views, reactions, comments, forwards):
-    return round((reactions + forwards + comments) / views * 100, 2) if views > 0 else 0
+    """Engagement in percent; accepts numbers or NumPy arrays of equal length"""
+    views = np.asarray(views, dtype=np.float64)
+    interactions = np.asarray(reactions, dtype=np.float64) + forwards + comments
+    with np.errstate(divide="ignore", invalid="ignore"):
+        engagement = np.where(views > 0, np.round(interactions / views * 100, 2), 0.0)
+    return engagement if engagement.ndim else float(engagement)
 
 
-def extract_top_posts(company_id: int, company_name: str, channels_data, days_back, top_n):
-    final_rows = []
-    os.makedirs("extracted_data", exist_ok=True)
-    
-    all_posts = []
-    all_stats = []
-    
-    for ch in channels_data:
-        logger.info(f"🔍 Анализируем канал: {ch['Название канала']}")
-        channel_id = ch['ID']
+def _to_number(value) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class PostTable:
+    """One channel's scored posts as NumPy-ready columns for vectorized scoring and top-N selection.
+
+    Only numbers and the caller's index of the source post are stored; the caller
+    builds sheet rows for the selected posts only.
+    """
+
+    COLUMNS = ("source", "views", "reactions", "comments", "forwards", "timestamp")
+
+    def __init__(self):
+        self._columns = {name: array("q" if name == "source" else "d") for name in self.COLUMNS}
+
+    def __len__(self):
+        return len(self._columns["source"])
+
+    def append(self, source: int, post, stats):
+        columns = self._columns
+        columns["source"].append(source)
+        columns["views"].append(_to_number(stats.get("viewsCount", 0)))
+        columns["reactions"].append(_to_number(stats.get("reactionsCount", 0)))
+        columns["comments"].append(_to_number(stats.get("commentsCount", 0)))
+        columns["forwards"].append(_to_number(stats.get("forwardsCount", 0)))
+        columns["timestamp"].append(_post_position(post)[0])
+
+    def arrays(self) -> dict:
+        return {name: np.array(values, dtype=np.int64 if values.typecode == "q" else np.float64)
+                for name, values in self._columns.items()}
+
+    def scores(self, arrays: dict, score: str = "engagement"):
+        engagement = calculate_engagement(arrays["views"], arrays["reactions"], arrays["comments"], arrays["forwards"])
+        if score == "engagement":
+            return engagement
+        if score == "recency":
+            age_hours = np.maximum(time.time() - arrays["timestamp"], 0) / 3600
+            return engagement * 0.5 ** (age_hours / RECENCY_HALF_LIFE_HOURS)
+        raise ValueError(f"Неизвестный способ ранжирования: {score}")
+
+    def top(self, top_n: int, score: str = "engagement"):
+        """(source, engagement) of the top_n posts, best first; ties keep the insertion order"""
+        if not len(self) or top_n <= 0:
+            return []
+        arrays = self.arrays()
+        engagement = self.scores(arrays, "engagement")
+        ranking = engagement if score == "engagement" else self.scores(arrays, score)
+        candidates = np.arange(len(ranking))
+        if len(ranking) > top_n:
+            # частичный отбор вместо полной сортировки; при равенстве на границе берём более ранние посты
+            kth = np.partition(ranking, len(ranking) - top_n)[len(ranking) - top_n]
+            above = candidates[ranking > kth]
+            candidates = np.concatenate([above, candidates[ranking == kth][:top_n - len(above)]])
+        selected = candidates[np.lexsort((candidates, -ranking[candidates]))]
+        return [(int(arrays["source"][i]), float(engagement[i])) for i in selected]
+
+
+def build_post_row(ch, post, stats, engagement):
+    """Row of the Рекомендации sheet"""
+    text = post.get("text", "")
+    views = stats.get("viewsCount", 0)
+    reactions = stats.get("reactionsCount", 0)
+    comments = stats.get("commentsCount", 0)
+    forwards = stats.get("forwardsCount", 0)
+    media = post.get("media", {})
+    file_url = media.get("file_url", "")
+    video_link = file_url if file_url and file_url.endswith(
+        ".mp4") else ""
+    date_only, time_only = transform_to_normal_date(
+        post.get("date", ""))
+    post_length = len(text) if text else 0
+    return [
+        ch['Название канала'],
+        ch["Количество подписчиков"],
+        text,
+        post.get("link", ""),
+        video_link,
+        date_only,
+        time_only,
+        post_length,
+        views,
+        reactions,
+        comments,
+        forwards,
+        engagement
+    ]
+
+
+def prefilter_by_views(posts, limit):
+    """Keep `limit` most viewed posts using views from channels/posts (extended=1)"""
+    if limit is None or len(posts) <= limit or any("views" not in post for post in posts):
+        return posts
+    candidates = heapq.nlargest(limit, posts, key=lambda post: post.get("views") or 0)
+    # исходный порядок постов сохраняется
+    candidate_ids = {id(post) for post in candidates}
+    return [post for post in posts if id(post) in candidate_ids]
+
+
+def extract_top_posts(company_id: int, company_name: str, channels_data, days_back, top_n, delta: DeltaState = None,
+                      prefilter_margin=STATS_PREFILTER_MARGIN, ranking_score=RANKING_SCORE):
+    # Сырые ответы дописываются по мере обработки каналов, а не держатся в памяти
+    output_dir = extracted_data_dir(company_id, datetime.now().strftime("%Y%m%dT%H%M%S"))
+    posts_writer = JsonlWriter(os.path.join(output_dir, "channels_stats.jsonl"), EXTRACTED_DATA_COMPRESSION)
+    stats_writer = JsonlWriter(os.path.join(output_dir, "posts_stats.jsonl"), EXTRACTED_DATA_COMPRESSION)
+
+    # Каналы обрабатываются параллельно и целиком: посты, затем статистика постов;
+    # каждый канал записывается на диск и ранжируется, как только готов, а его ответы
+    # сразу отбрасываются — в памяти остаются только выбранные строки
+    def fetch_channel(ch_idx):
+        ch = channels_data[ch_idx]
+        with metrics.span("channel_posts_seconds", client=company_id, channel=ch['ID']):
+            posts = shared_fetches.posts(ch['ID'], days_back, since=delta.since(ch['ID']) if delta else None)
+        candidates = posts
+        if delta:
+            # Уже обработанные посты отсекаем до запросов статистики и LLM
+            candidates = delta.filter_new(ch['ID'], candidates)
+        candidates = [post for post in candidates if post.get("text", "").strip() and post.get("link", "")]
+        checked = candidates
+        if prefilter_margin is not None:
+            # posts/stat запрашиваем только для постов, которые могут попасть в топ
+            checked = prefilter_by_views(candidates, top_n + prefilter_margin)
+        stat_futures = [stats_pool.submit(shared_fetches.post_stats, post["link"], post.get("date"))
+                        for post in checked]
+        channel_stats = []
+        for post, future in zip(checked, stat_futures):
+            try:
+                channel_stats.append((post, future.result(), None))
+            except Exception as e:
+                channel_stats.append((post, None, e))
+        # Отсечённые префильтром посты идут без статистики: водяной знак не должен уйти за них
+        checked_ids = {id(post) for post in checked}
+        channel_stats.extend((post, None, None) for post in candidates if id(post) not in checked_ids)
+        return posts, channel_stats
+
+    rows_by_channel = {}
+    stats_pool = ThreadPoolExecutor(max_workers=TGSTAT_MAX_WORKERS)
+    try:
+        with ThreadPoolExecutor(max_workers=TGSTAT_MAX_WORKERS) as channel_pool:
+            channel_futures = {channel_pool.submit(fetch_channel, ch_idx): ch_idx
+                               for ch_idx in range(len(channels_data))}
+            for future in as_completed(channel_futures):
+                ch_idx = channel_futures.pop(future)
+                ch = channels_data[ch_idx]
+                logger.info(f"🔍 Анализируем канал: {ch['Название канала']}")
+                channel_id = ch['ID']
+                try:
+                    posts, channel_posts_stats = future.result()
+                    if not posts:
+                        # Warning
+                        raise Exception(f"Нет постов в канале")
+
+                    # Collect posts for JSON
+                    posts_writer.append([{
+                        "channel_id": channel_id,
+                        "channel_name": ch['Название канала'],
+                        "post": post,
+                        "timestamp": datetime.now().isoformat()
+                    } for post in posts])
+
+                    if delta and delta.incremental and not channel_posts_stats:
+                        logger.info(f"Новых постов в канале {ch['Название канала']} нет")
+                        continue
+
+                    channel_stats = []
+                    scored = []
+                    unscored = []
+                    table = PostTable()
+                    for post, stats, error in channel_posts_stats:
+                        post_link = post.get("link", "")
+                        if error:
+                            # Ошибка одного поста (после всех повторов) не должна ронять весь канал
+                            logger.warning(f"Пропускаем пост {post_link}: {error}")
+                            unscored.append(post)
+                            continue
+                        if not stats:
+                            unscored.append(post)
+                            continue
+
+                        # Collect stats for JSON
+                        channel_stats.append({
+                            "channel_id": channel_id,
+                            "channel_name": ch['Название канала'],
+                            "post_link": post_link,
+                            "stats": stats,
+                            "timestamp": datetime.now().isoformat()
+                        })
+                        table.append(len(scored), post, stats)
+                        scored.append((post, stats))
+
+                    stats_writer.append(channel_stats)
+                    rows_by_channel[ch_idx] = [build_post_row(ch, *scored[source], engagement)
+                                               for source, engagement in table.top(top_n, ranking_score)]
+                    # Водяной знак останавливается перед самым старым постом без статистики
+                    # (ошибка posts/stat или префильтр), каналы с ошибкой его не сдвигают —
+                    # такие посты следующий запуск рассмотрит снова
+                    if delta:
+                        delta.advance(channel_id, [post for post, _ in scored], unscored)
+
+                except Exception as e:
+                    # Warning
+                    sheet_writer.log(company_id, company_name, f"Ошибка при обработке {channel_id}: {e}")
+    finally:
+        stats_pool.shutdown(wait=False, cancel_futures=True)
+
+    # строки в порядке каналов, как в листе каналов
+    return [row for ch_idx in sorted(rows_by_channel) for row in rows_by_channel[ch_idx]]
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    """Token count with tiktoken if installed, otherwise a length-based estimate"""
+    if not text:
+        return 0
+    if tiktoken is not None:
+        return len(_encoding(model).encode(text, disallowed_special=()))
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def count_message_tokens(messages, model: str = "gpt-4o") -> int:
+    # ~4 служебных токена на сообщение и 3 на начало ответа
+    return sum(count_tokens(m["content"], model) + 4 for m in messages) + 3
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "gpt-4o") -> str:
+    if count_tokens(text, model) <= max_tokens:
+        return text
+    # один токен оставляем на многоточие
+    limit = max(max_tokens - 1, 1)
+    if tiktoken is not None:
+        encoding = _encoding(model)
+        cut = encoding.decode(encoding.encode(text, disallowed_special=())[:limit])
+    else:
+        cut = text[:limit * CHARS_PER_TOKEN]
+    # не рвём слово посередине
+    if " " in cut[len(cut) // 2:]:
+        cut = cut[:cut.rindex(" ")]
+    return cut.rstrip() + " …"
+
+
+def compact_text(text: str, max_tokens: int, purpose: str, model: str = "gpt-4o") -> str:
+    """Fit text into max_tokens by truncation or, with PROMPT_COMPACTION=summarize, by an LLM summary"""
+    tokens = count_tokens(text, model)
+    if tokens <= max_tokens:
+        return text
+
+    compacted = None
+    if PROMPT_COMPACTION == "summarize":
+        prompt = f"""
+    Сократи текст примерно до {max_tokens * 2 // 3} слов. Сохрани ключевые факты, цифры, выводы и тон.
+    Пришли ТОЛЬКО сокращённый текст.
+    "{truncate_to_tokens(text, COMPACTION_INPUT_MAX_TOKENS, COMPACTION_MODEL)}"
+    """
         try:
-            posts = get_top_posts(channel_id, days_back)
-            if not posts:
-                # Warning
-                raise Exception(f"Нет постов в канале")
-                
-            # Collect posts for JSON
-            all_posts.extend([{
-                "channel_id": channel_id,
-                "channel_name": ch['Название канала'],
-                "post": post,
-                "timestamp": datetime.now().isoformat()
-            } for post in posts])
-            
-            channel_posts = []
-            for post in posts:
-                text = post.get("text", "")
-                if len(text.strip()) == 0:
-                    continue
-                post_link = post.get("link", "")
-                if not post_link:
-                    continue
-                stats = fetch_post_stats(post_link)
-                if not stats:
+            compacted = openai_chat(
+                "compaction",
+                model=COMPACTION_MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.2
+            )
+        except openai.OpenAIError as e:
+            logger.warning(f"⚠️ Не удалось сжать {purpose} через {COMPACTION_MODEL}, обрезаем: {e}")
+    compacted = truncate_to_tokens(compacted or text, max_tokens, model)
+
+    mode = PROMPT_COMPACTION if PROMPT_COMPACTION == "summarize" else "truncate"
+    metrics.inc("prompt_compactions_total", purpose=purpose, mode=mode)
+    logger.info(f"✂️ {purpose}: {tokens} → {count_tokens(compacted, model)} токенов ({mode})")
+    return compacted
+
+
+def llm_cache_key(purpose, model, messages, temperature) -> str:
+    payload = json.dumps([purpose, model, messages, temperature], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class BatchPending(Exception):
+    """The request was queued for the OpenAI batch; its answer will be in llm_cache once the batch is done"""
+
+
+class OpenAIBatch:
+    """Chat requests deferred to the OpenAI Batch API.
+
+    While `collecting`, openai_chat queues requests of OPENAI_BATCH_PURPOSES and raises BatchPending.
+    run() submits them with custom_id = llm cache key and stores the answers in llm_cache,
+    so the repeated pass over the same rows gets them as ordinary cache hits. Keys answered
+    by this run are remembered, so LLM_CACHE_BYPASS does not hide them.
+    """
+
+    def __init__(self):
+        self.collecting = False
+        self.answered = set()
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._requests)
+
+    def defer(self, key, model, messages, temperature):
+        with self._lock:
+            self._requests[key] = {
+                "custom_id": key,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {"model": model, "messages": messages, "temperature": temperature},
+            }
+        raise BatchPending(key)
+
+    def run(self) -> int:
+        """Submit queued requests, wait for the batches and cache the answers; returns the number of answers"""
+        with self._lock:
+            requests_, self._requests = list(self._requests.values()), {}
+        if not requests_:
+            return 0
+        if len(requests_) > llm_cache.max_entries:
+            logger.warning(f"⚠️ В пакете {len(requests_)} запросов, а LLM_CACHE_MAX_ENTRIES = {llm_cache.max_entries}: "
+                           f"часть ответов вытеснится из кэша и будет запрошена повторно")
+
+        run_id = datetime.now().strftime("%Y%m%dT%H%M%S")
+        batches = []
+        for part, start in enumerate(range(0, len(requests_), OPENAI_BATCH_MAX_REQUESTS)):
+            writer = JsonlWriter(os.path.join(CACHE_DIR, "openai_batches", f"{run_id}-{part}.jsonl"))
+            writer.append(requests_[start:start + OPENAI_BATCH_MAX_REQUESTS])
+            with open(writer.path, "rb") as f:
+                input_file = ctx.openai.files.create(file=f, purpose="batch")
+            batch = ctx.openai.batches.create(input_file_id=input_file.id, endpoint="/v1/chat/completions",
+                                              completion_window="24h")
+            logger.info(f"📦 Пакет OpenAI {batch.id}: {min(OPENAI_BATCH_MAX_REQUESTS, len(requests_) - start)} запросов")
+            batches.append(batch)
+
+        deadline = time.monotonic() + OPENAI_BATCH_TIMEOUT.total_seconds()
+        answers = 0
+        while batches:
+            time.sleep(OPENAI_BATCH_POLL_INTERVAL)
+            for batch in list(batches):
+                batch = ctx.openai.batches.retrieve(batch.id)
+                if batch.status in ("validating", "in_progress", "finalizing", "cancelling"):
                     continue
-                    
-                # Collect stats for JSON
-                all_stats.append({
-                    "channel_id": channel_id,
-                    "channel_name": ch['Название канала'],
-                    "post_link": post_link,
-                    "stats": stats,
-                    "timestamp": datetime.now().isoformat()
-                })
-                
-                views = stats.get("viewsCount", 0)
-                reactions = stats.get("reactionsCount", 0)
-                comments = stats.get("commentsCount", 0)
-                forwards = stats.get("forwardsCount", 0)
-                engagement = calculate_engagement(
-                    views, reactions, comments, forwards)
-                post["engagement"] = engagement
-                post["views"] = views
-                post["reactions"] = reactions
-                post["comments"] = comments
-                post["forwards"] = forwards
-                post["channel_info"] = ch
-                post["processed_stats"] = stats
-                channel_posts.append(post)
-                
-            top_channel_posts = sorted(
-                channel_posts, key=lambda x: x["engagement"], reverse=True
-            )[:top_n]
-            
-            for post in top_channel_posts:
-                text = post.get("text", "")
-                views = post.get("views", 0)
-                reactions = post.get("reactions", 0)
-                comments = post.get("comments", 0)
-                forwards = post.get("forwards", 0)
-                engagement = post.get("engagement", 0)
-                post_link = post.get("link", "")
-                media = post.get("media", {})
-                file_url = media.get("file_url", "")
-                video_link = file_url if file_url and file_url.endswith(
-                    ".mp4") else ""
-                date_only, time_only = transform_to_normal_date(
-                    post.get("date", ""))
-                post_length = len(text) if text else 0
-                row = [
-                    ch['Название канала'],
-                    ch["Количество подписчиков"],
-                    text,
-                    post_link,
-                    video_link,
-                    date_only,
-                    time_only,
-                    post_length,
-                    views,
-                    reactions,
-                    comments,
-                    forwards,
-                    engagement
-                ]
-                final_rows.append(row)
-                
-        except Exception as e:
-            # Warning
-            admin_log.insert_row([company_id, company_name, f"Ошибка при обработке {channel_id}: {e}", datetime.today().isoformat()], 2)
-    
-    # Save posts to channels_stats.json
-    with open("extracted_data/channels_stats.json", "w", encoding="utf-8") as f:
-        json.dump(all_posts, f, ensure_ascii=False, indent=2)
-    
-    # Save stats to posts_stats.json
-    with open("extracted_data/posts_stats.json", "w", encoding="utf-8") as f:
-        json.dump(all_stats, f, ensure_ascii=False, indent=2)
-    
-    return final_rows
+                batches = [b for b in batches if b.id != batch.id]
+                logger.info(f"📦 Пакет OpenAI {batch.id}: {batch.status}")
+                if batch.output_file_id:
+                    answers += self._store_answers(ctx.openai.files.content(batch.output_file_id).text)
+                if batch.error_file_id or batch.status != "completed":
+                    logger.warning(f"⚠️ Пакет OpenAI {batch.id} ({batch.status}) выполнен не полностью, "
+                                   f"недостающие ответы будут запрошены напрямую")
+            if batches and time.monotonic() > deadline:
+                for batch in batches:
+                    ctx.openai.batches.cancel(batch.id)
+                logger.warning(f"⚠️ Пакеты OpenAI не завершились за {OPENAI_BATCH_TIMEOUT}, отменены")
+                break
+        return answers
+
+    def _store_answers(self, output: str) -> int:
+        answers = 0
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            body = response["body"]
+            usage = body.get("usage") or {}
+            metrics.inc("openai_tokens_total", usage.get("prompt_tokens", 0), purpose="batch", model=body.get("model"), kind="prompt")
+            metrics.inc("openai_tokens_total", usage.get("completion_tokens", 0), purpose="batch", model=body.get("model"), kind="completion")
+            llm_cache.set(item["custom_id"], body["choices"][0]["message"]["content"])
+            self.answered.add(item["custom_id"])
+            answers += 1
+        return answers
+
+
+openai_batch = OpenAIBatch()
+
+
+def openai_chat(purpose, model, messages, temperature, parse=None, use_cache=True):
+    """Chat completion limited by OPENAI_MAX_CONCURRENCY and cached by prompt hash.
+
+    Returns the message text, or parse(text) if given; a response that parse rejects is not cached.
+    Raises BatchPending if the request was queued for the OpenAI batch instead.
+    """
+    parse = parse or (lambda content: content)
+    key = llm_cache_key(purpose, model, messages, temperature)
+    # Ответ пакета этого запуска читаем из кэша даже при LLM_CACHE_BYPASS
+    if key in openai_batch.answered or (use_cache and not LLM_CACHE_BYPASS):
+        cached = llm_cache.get(key)
+        if cached is not None:
+            try:
+                result = parse(cached)
+            except Exception:
+                # ответ из пакета не прошёл разбор — запрашиваем заново
+                llm_cache.delete(key)
+            else:
+                metrics.inc("openai_requests_total", purpose=purpose, model=model, source="cache")
+                return result
+    # Режим пакета не зависит от чтения кэша: ответы доставляются через llm_cache в любом случае
+    if openai_batch.collecting and purpose in OPENAI_BATCH_PURPOSES:
+        metrics.inc("openai_requests_total", purpose=purpose, model=model, source="batch")
+        openai_batch.defer(key, model, messages, temperature)
+
+    estimated_tokens = count_message_tokens(messages, model)
+    if estimated_tokens > PROMPT_WARN_TOKENS:
+        logger.warning(f"⚠️ Промпт {purpose} для {model}: ~{estimated_tokens} токенов")
+
+    with openai_semaphore, metrics.span("openai_request_seconds", purpose=purpose, model=model):
+        response = ctx.openai.chat.completions.create(
+            model=model,
+            messages=messages,
+            temperature=temperature
+        )
+    metrics.inc("openai_requests_total", purpose=purpose, model=model, source="api")
+    content = response.choices[0].message.content
+    usage = getattr(response, "usage", None)
+    prompt_tokens = usage.prompt_tokens if usage is not None else estimated_tokens
+    completion_tokens = usage.completion_tokens if usage is not None else count_tokens(content or "", model)
+    metrics.inc("openai_tokens_total", prompt_tokens, purpose=purpose, model=model, kind="prompt")
+    metrics.inc("openai_tokens_total", completion_tokens, purpose=purpose, model=model, kind="completion")
+    logger.info(f"🧮 {purpose} ({model}): отправлено {prompt_tokens} токенов, получено {completion_tokens}")
+    result = parse(content)
+    llm_cache.set(key, content)
+    return result
 
 
 def translate_into_russian(text):
+    text = compact_text(text, TRANSCRIPT_MAX_TOKENS, "transcript", model="gpt-4o-mini")
     prompt = f"""
     Переведи текст на русский язык и пришли ТОЛЬКО перведенный текст.
     \"{text}\"
     """
-    response = client1.chat.completions.create(
+    response_text = openai_chat(
+        "translation",
         model="gpt-4o-mini",
         messages=[
             {"role": "user", "content": prompt}
         ],
         temperature=0.8
     )
-    return response.choices[0].message.content
+    return response_text
 
 
 def extract_json_from_response(content):
     """Extract JSON from markdown-wrapped content"""
-    match = re.search(r"```json\s*(\{.*?\})\s*```", content, re.DOTALL)
+    match = re.search(r"```json\s*(\{.*?\}|\[.*?\])\s*```", content, re.DOTALL)
     try:
         if match:
             json_str = match.group(1)
@@ -322,26 +1688,31 @@ def extract_json_from_response(content):
         raise Exception(f"Ошибка при парсинге JSON: {e}")
 
 
-def generate_index_name(url: str) -> str:
-    """Generate unique index name based on video URL"""
-    parsed = urlparse(url)
-    basename = os.path.basename(parsed.path)
-    name_hash = hashlib.md5(url.encode()).hexdigest()[:6]
-    return f"video-index-{basename}-{name_hash}"
+def generate_index_name(company_id: int) -> str:
+    """Name of the index shared by all videos of the company"""
+    return f"company-index-{company_id}"
+
+
+_indexes_by_name = None
+_indexes_lock = threading.Lock()
 
 
 def get_or_create_index(name: str):
     """Create the index (only if not exists)"""
-    existing = client2.indexes.list()
-    for idx in existing:
-        if idx.index_name == name:
-            logger.info(f"✅ Используем существующий индекс: {idx.index_name}")
-            return idx
-
-    models = [{"model_name": "pegasus1.2", "model_options": ["visual", "audio"]}]
-    index = client2.indexes.create(index_name=name, models=models)
-    logger.info(f"✅ Индекс создан: id={index.id}")
-    return index
+    global _indexes_by_name
+    with _indexes_lock:
+        # Полный список индексов запрашиваем один раз за процесс
+        if _indexes_by_name is None:
+            _indexes_by_name = {idx.index_name: idx for idx in ctx.twelvelabs.indexes.list()}
+        if name in _indexes_by_name:
+            logger.info(f"✅ Используем существующий индекс: {name}")
+            return _indexes_by_name[name]
+
+        models = [{"model_name": "pegasus1.2", "model_options": ["visual", "audio"]}]
+        index = ctx.twelvelabs.indexes.create(index_name=name, models=models)
+        _indexes_by_name[name] = index
+        logger.info(f"✅ Индекс создан: id={index.id}")
+        return index
 
 # TODO: remove function
 def download_video(url: str) -> str:
@@ -349,7 +1720,7 @@ def download_video(url: str) -> str:
     logger.info("📥 Загружаем видео...")
     with tempfile.NamedTemporaryFile(delete=False, suffix=".mp4") as tmp_file:
         video_path = tmp_file.name
-        response = requests.get(url, stream=True, timeout=60)
+        response = http_get(url, stream=True, timeout=60)
         response.raise_for_status()
         for chunk in response.iter_content(chunk_size=8192):
             if chunk:
@@ -358,53 +1729,302 @@ def download_video(url: str) -> str:
     return video_path
 
 
-def transcribe_video(url: str) -> str:
-    """Transcribe and summarize video"""
-    if not url or not url.strip():
-        return ""
+def read_video_range(url: str, start: int, length: int):
+    """Read up to length bytes of the video from offset start with a Range request, return (data, total_size)"""
+    response = http_get(url, stream=True, timeout=60, headers={"Range": f"bytes={start}-{start + length - 1}"})
+    try:
+        response.raise_for_status()
+        if response.status_code == 206:
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+        elif start == 0:
+            # Сервер не поддерживает Range и отдаёт файл целиком — дочитываем только начало
+            total = response.headers.get("Content-Length", "")
+        else:
+            raise Exception(f"Сервер не поддерживает Range-запросы: HTTP {response.status_code}")
+        data = bytearray()
+        for chunk in response.iter_content(chunk_size=8192):
+            data += chunk
+            if len(data) >= length:
+                break
+        return bytes(data[:length]), int(total) if total.isdigit() else None
+    finally:
+        response.close()
+
+
+def _mvhd_duration(moov: bytes):
+    """Duration in seconds from the mvhd box at the start of moov payload"""
+    pos = 0
+    while pos + 8 <= len(moov):
+        box_size, box_type = struct.unpack(">I4s", moov[pos:pos + 8])
+        if box_type == b"mvhd":
+            if moov[pos + 8] == 1:
+                timescale, duration = struct.unpack(">IQ", moov[pos + 28:pos + 40])
+            else:
+                timescale, duration = struct.unpack(">II", moov[pos + 20:pos + 28])
+            return duration / timescale if timescale else None
+        if box_size < 8:
+            break
+        pos += box_size
+    return None
+
+
+def mp4_duration(read, size=None):
+    """Walk top-level MP4 boxes with read(offset, length) until moov and return its duration in seconds"""
+    offset = 0
+    while size is None or offset + 8 <= size:
+        header = read(offset, 16)
+        if len(header) < 8:
+            return None
+        box_size, box_type = struct.unpack(">I4s", header[:8])
+        header_size = 8
+        if box_size == 1:
+            box_size, header_size = struct.unpack(">Q", header[8:16])[0], 16
+        elif box_size == 0:
+            box_size = (size or 0) - offset
+        if box_type == b"moov":
+            # mvhd идёт первым в moov, 4 КБ хватает с запасом
+            return _mvhd_duration(read(offset + header_size, min(box_size - header_size, 4096)))
+        if box_size < header_size:
+            return None
+        offset += box_size
+    return None
+
+
+def probe_video(url: str) -> dict:
+    """Size, duration and content fingerprint of a video from its first and last VIDEO_PROBE_BYTES"""
+    head, size = read_video_range(url, 0, VIDEO_PROBE_BYTES)
+    tail = b""
+    if size and size > len(head):
+        tail_start = max(len(head), size - VIDEO_PROBE_BYTES)
+        try:
+            tail, _ = read_video_range(url, tail_start, size - tail_start)
+        except Exception as e:
+            # Без конца файла отпечаток строится по началу и размеру
+            logger.warning(f"⚠️ Не удалось прочитать конец видео {url}: {e}")
+
+    def read(offset, length):
+        # moov обычно в начале или в конце файла — их уже прочитали, середину дочитываем отдельно
+        if offset + length <= len(head) or size == len(head):
+            return head[offset:offset + length]
+        if tail and offset >= size - len(tail):
+            return tail[offset - (size - len(tail)):][:length]
+        return read_video_range(url, offset, length)[0]
 
     try:
-        # video_path = download_video(url)
-        index_name = generate_index_name(url)
-        index = get_or_create_index(index_name)
+        duration = mp4_duration(read, size)
+    except Exception:
+        # Не mp4 или сервер не отдал нужный кусок — длительность неизвестна, отпечаток всё равно есть
+        duration = None
+    fingerprint = hashlib.sha256(f"{size}:".encode() + head + tail).hexdigest()
+    return {"size": size, "duration": duration, "fingerprint": fingerprint}
+
+
+def get_video_probe(url: str) -> dict:
+    """probe_video result, remembered between runs"""
+    key = f"probe:{url}"
+    probe = video_cache.get(key)
+    if probe is None:
+        with metrics.span("video_probe_seconds"):
+            probe = probe_video(url)
+        video_cache.set(key, probe)
+    return probe
+
+
+def video_skip_reason(probe: dict) -> str:
+    """Why the video should not be indexed, or empty string"""
+    size, duration = probe["size"], probe["duration"]
+    if size and size > VIDEO_MAX_BYTES:
+        return f"размер {size / 1024 ** 2:.0f} МБ больше {VIDEO_MAX_BYTES / 1024 ** 2:.0f} МБ"
+    if duration is not None and duration < VIDEO_MIN_SECONDS:
+        return f"длительность {duration:.1f} с меньше {VIDEO_MIN_SECONDS:g} с"
+    if duration is not None and duration > VIDEO_MAX_SECONDS:
+        return f"длительность {duration:.0f} с больше {VIDEO_MAX_SECONDS:g} с"
+    return ""
+
+
+def prepare_videos(urls) -> dict:
+    """Map each video url to the url to index instead (the first seen copy of the same clip), or None to skip it"""
+    plan = {}
+    # отпечаток -> url, который индексируется в этом вызове
+    owners = {}
+    to_probe = []
+    for url in dict.fromkeys(urls):
+        # Уже проиндексированные видео не проверяем
+        if get_cached_video(url).get("video_id"):
+            plan[url] = url
+        else:
+            to_probe.append(url)
 
-        # with open(video_path, "rb") as video_file:
-        task = client2.tasks.create(index_id=index.id, video_url=url)
-        logger.info(f"🚀 Task started: id={task.id}, video_id={task.video_id}")
+    for url, (probe, error) in zip(to_probe, run_concurrently(get_video_probe, to_probe)):
+        if error:
+            # Проверка — только оптимизация, видео индексируем как раньше
+            logger.warning(f"⚠️ Не удалось проверить видео {url}: {error}")
+            plan[url] = url
+            continue
+        reason = video_skip_reason(probe)
+        if reason:
+            logger.info(f"⏭️ Пропускаем видео {url}: {reason}")
+            metrics.inc("videos_skipped_total")
+            plan[url] = None
+            continue
+        fingerprint = probe["fingerprint"]
+        original = owners.get(fingerprint)
+        if original is None:
+            # Владелец из прошлых запусков подходит, только если уже проиндексирован:
+            # file_url со временем перестают открываться, а скачивать его снова не нужно
+            stored = (video_cache.get(f"fingerprint:{fingerprint}") or {}).get("url")
+            cached = get_cached_video(stored) if stored and stored != url else {}
+            if cached.get("video_id") or cached.get("summary"):
+                original = owners[fingerprint] = stored
+        if original and original != url:
+            logger.info(f"♻️ Видео {url} совпадает с {original}, индексируем один раз")
+            metrics.inc("videos_deduplicated_total")
+            plan[url] = original
+        else:
+            owners[fingerprint] = url
+            video_cache.set(f"fingerprint:{fingerprint}", {"url": url})
+            plan[url] = url
+    return plan
 
-        def on_task_update(task: TasksRetrieveResponse):
-            logger.info(f"⏳ Status = {task.status}")
 
-        task = client2.tasks.wait_for_done(task_id=task.id, callback=on_task_update)
+def twelvelabs_error(e: Exception) -> Exception:
+    """Human-readable exception for TwelveLabs API errors"""
+    if isinstance(e, ApiError):
+        error_body = getattr(e, 'body', {})
+        if isinstance(error_body, dict):
+            return Exception(f"Ошибка TwelveLabs API: {error_body}")
+        return Exception(f"Ошибка TwelveLabs API: {e}")
+    if isinstance(e, TooManyRequestsError):
+        return Exception("Ошибка TwelveLabs API: превышен лимит запросов")
+    return e
 
-        if task.status != "ready":
-            raise RuntimeError(f"Indexing failed with status: {task.status}")
 
+class VideoIndexingQueue:
+    """Indexing tasks of one company, submitted up front and polled together by a background thread.
 
-        res = client2.summarize(video_id=task.video_id,
-                               type="summary", prompt=PEGASUS_SYS_ROLE)
+    submit() returns at once with a Future that resolves to (index_id, video_id) when the task is ready.
+    """
 
-        # if os.path.exists(video_path):
-        #     os.remove(video_path)
+    def __init__(self, company_id: int):
+        self.company_id = company_id
+        self._new = []
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = None
+
+    def submit(self, url: str) -> Future:
+        future = Future()
+        with self._lock:
+            self._new.append((url, future))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+        return future
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+
+    def _create_tasks(self) -> bool:
+        with self._lock:
+            new, self._new = self._new, []
+        for url, future in new:
+            try:
+                with twelvelabs_semaphore:
+                    # video_path = download_video(url)
+                    index = get_or_create_index(generate_index_name(self.company_id))
+                    # with open(video_path, "rb") as video_file:
+                    with metrics.span("twelvelabs_request_seconds", method="tasks.create"):
+                        task = ctx.twelvelabs.tasks.create(index_id=index.id, video_url=url)
+                logger.info(f"🚀 Task started: id={task.id}, video_id={task.video_id}")
+                self._pending[task.id] = {"url": url, "index_id": index.id, "future": future,
+                                          "status": None, "errors": 0, "started": time.monotonic()}
+            except Exception as e:
+                future.set_exception(e)
+        return bool(new)
 
-        return res.summary
-    except ApiError as e:
-        error_body = getattr(e, 'body', {})
-        if isinstance(error_body, dict):
-            raise Exception(f"Ошибка TwelveLabs API: {error_body}")
-        raise Exception(f"Ошибка TwelveLabs API: {e}")
-    except TooManyRequestsError as e:
-        raise Exception("Ошибка TwelveLabs API: превышен лимит запросов")
-    except Exception as e:
-        # if 'video_path' in locals() and os.path.exists(video_path):
-        #     os.remove(video_path)
+    def _poll(self) -> bool:
+        changed = False
+        for task_id, job in list(self._pending.items()):
+            try:
+                with twelvelabs_semaphore, metrics.span("twelvelabs_request_seconds", method="tasks.retrieve"):
+                    task = ctx.twelvelabs.tasks.retrieve(task_id)
+            except Exception as e:
+                metrics.inc("twelvelabs_errors_total", method="tasks.retrieve")
+                job["errors"] += 1
+                if job["errors"] >= VIDEO_POLL_MAX_ERRORS:
+                    del self._pending[task_id]
+                    job["future"].set_exception(e)
+                    changed = True
+                continue
+
+            if task.status != job["status"]:
+                logger.info(f"⏳ Task {task_id}: status = {task.status}")
+                job["status"] = task.status
+                changed = True
+            if task.status == "ready":
+                del self._pending[task_id]
+                metrics.observe("video_indexing_seconds", time.monotonic() - job["started"])
+                video_cache.set(job["url"], {"index_id": job["index_id"], "video_id": task.video_id})
+                job["future"].set_result((job["index_id"], task.video_id))
+            elif task.status == "failed":
+                del self._pending[task_id]
+                job["future"].set_exception(RuntimeError(f"Indexing failed with status: {task.status}"))
+        return changed
+
+    def _run(self):
+        interval = VIDEO_POLL_MIN_INTERVAL
+        while not self._closed:
+            self._wakeup.clear()
+            self._create_tasks()
+            with self._lock:
+                if not self._pending and not self._new:
+                    self._thread = None
+                    return
+            if self._poll():
+                interval = VIDEO_POLL_MIN_INTERVAL
+            else:
+                interval = min(interval * 1.5, VIDEO_POLL_MAX_INTERVAL)
+            if self._pending:
+                self._wakeup.wait(interval)
+
+        for job in self._pending.values():
+            job["future"].set_exception(RuntimeError("Очередь индексации видео остановлена"))
+        self._pending.clear()
+
+
+def _video_prompt_hash() -> str:
+    return hashlib.sha256(ctx.pegasus_sys_role.encode("utf-8")).hexdigest()[:16]
+
+
+def get_cached_video(url: str) -> dict:
+    """Cached {index_id, video_id, summary} for the video; summary only if made with the current prompt"""
+    cached = video_cache.get(url) or {}
+    if cached.get("summary") and cached.get("prompt") != _video_prompt_hash():
+        cached.pop("summary")
+    return cached
+
+
+def summarize_video(url: str, index_id: str, video_id: str, reindex_on_error=False) -> str:
+    """Summarize an indexed video and remember the summary"""
+    try:
+        with twelvelabs_semaphore, metrics.span("twelvelabs_request_seconds", method="summarize"):
+            res = ctx.twelvelabs.summarize(video_id=video_id,
+                                   type="summary", prompt=ctx.pegasus_sys_role)
+    except ApiError:
+        # Видео могли удалить из индекса — в следующий раз проиндексируем заново
+        if reindex_on_error:
+            video_cache.delete(url)
         raise
+    video_cache.set(url, {"index_id": index_id, "video_id": video_id,
+                          "summary": res.summary, "prompt": _video_prompt_hash()})
+    return res.summary
 
 
-def rewrite_post_into_blocks(post_text):
-    """Analyze post and return structured data"""
-    prompt = f"""
-    Проанализируй следующий Telegram-пост и ответь строго в JSON формате по полям:
+ANALYSIS_FIELDS = """
     - tema: тема поста (коротко)
     - format: формат (текст / видео / карусель / опрос и т.п.)
     - length: длина поста в символах
@@ -418,23 +2038,77 @@ def rewrite_post_into_blocks(post_text):
     - insight: краткий вывод, в чём сила поста
     - filter: определи, является ли пост Личным или Профессиональным. 
       `Личное` — посты о личных мероприятиях, личных вещах, событиях, не связанных с сельским хозяйством.
-      `Профессиональное` — посты, связанные с сельским хозяйством, кормами, животноводством, советами для фермеров.
+      `Профессиональное` — посты, связанные с сельским хозяйством, кормами, животноводством, советами для фермеров."""
+ANALYSIS_KEYS = ("tema", "format", "length", "style", "cta", "zagolovok_5_slov", "zagolovok_len",
+                 "fact", "benefit", "comment_call", "insight", "filter")
+
+
+def rewrite_post_into_blocks(post_text):
+    """Analyze post and return structured data"""
+    post_text = compact_text(post_text, POST_MAX_TOKENS, "post")
+    prompt = f"""
+    Проанализируй следующий Telegram-пост и ответь строго в JSON формате по полям:{ANALYSIS_FIELDS}
     Текст поста:
     \"\"\"{post_text}\"\"\"
     """
-    response = client1.chat.completions.create(
+    analysis = openai_chat(
+        "analysis",
         model="gpt-4o",
-        messages=[{"role": "system", "content": OPENAI_SYS_ROLE},
+        messages=[{"role": "system", "content": ctx.openai_sys_role},
                     {"role": "user", "content": prompt}],
-        temperature=0.4
+        temperature=0.4,
+        parse=extract_json_from_response
     )
-    response_text = response.choices[0].message.content
 
-    return extract_json_from_response(response_text)
+    return analysis
+
+
+def rewrite_posts_into_blocks(post_texts):
+    """Analyze several posts in one request, re-analyze separately only the items that came back invalid"""
+    if len(post_texts) == 1:
+        return [rewrite_post_into_blocks(post_texts[0])]
+
+    post_texts = [compact_text(text, POST_MAX_TOKENS, "post") for text in post_texts]
+    posts_block = "\n".join(f'Пост {i}:\n    \"\"\"{text}\"\"\"' for i, text in enumerate(post_texts))
+    prompt = f"""
+    Проанализируй каждый из следующих Telegram-постов по полям:{ANALYSIS_FIELDS}
+    Ответь строго JSON-массивом из {len(post_texts)} объектов, по одному на каждый пост.
+    В каждом объекте укажи поле index — номер поста — и все поля выше.
+    {posts_block}
+    """
+    try:
+        items = openai_chat(
+            "analysis_batch",
+            model="gpt-4o",
+            messages=[{"role": "system", "content": ctx.openai_sys_role},
+                        {"role": "user", "content": prompt}],
+            temperature=0.4,
+            parse=extract_json_from_response
+        )
+    except (openai.OpenAIError, BatchPending):
+        raise
+    except Exception as e:
+        logger.warning(f"Пакетный анализ вернул некорректный JSON: {e}")
+        items = []
+
+    results = [None] * len(post_texts)
+    for item in items if isinstance(items, list) else []:
+        if not isinstance(item, dict) or any(key not in item for key in ANALYSIS_KEYS):
+            continue
+        index = item.get("index")
+        if isinstance(index, int) and 0 <= index < len(post_texts) and results[index] is None:
+            results[index] = item
+
+    for i, result in enumerate(results):
+        if result is None:
+            logger.warning(f"Пакетный анализ не вернул пост {i}, анализируем отдельно")
+            results[i] = rewrite_post_into_blocks(post_texts[i])
+    return results
 
 
 def rewrite_post_with_context(post_text, context):
     """Rewrite post with company context"""
+    post_text = compact_text(post_text, POST_MAX_TOKENS, "post")
     prompt = f"""
     Контекст: {context}
     Ниже популярный пост из Telegram:
@@ -443,20 +2117,22 @@ def rewrite_post_with_context(post_text, context):
     Сохрани идею и пользу, но полностью перепиши текст под стиль ПрофКорм.
     Не упоминай чужие бренды. Пиши ясно, экспертно и по делу. Объём — до 2049 символов с пробелами.
     """
-    response = client1.chat.completions.create(
+    response_text = openai_chat(
+        "rewrite",
         model="gpt-4o",
-        messages=[{"role": "system", "content": OPENAI_SYS_ROLE},
+        messages=[{"role": "system", "content": ctx.openai_sys_role},
                     {"role": "user", "content": prompt}],
         temperature=0.8
     )
 
-    return response.choices[0].message.content
+    return response_text
 
 
 def create_video_suggestion(transcription, company_context):
     """Create video suggestion based on transcription and context"""
     if not transcription or transcription.startswith("Error:"):
         return ""
+    transcription = compact_text(transcription, TRANSCRIPT_MAX_TOKENS, "transcript")
 
     prompt = f"""
     Контекст компании: {company_context}
@@ -475,7 +2151,8 @@ def create_video_suggestion(transcription, company_context):
     Сохрани структуру и эмоциональное воздействие оригинала, но адаптируй под наш стиль и аудиторию.
     """
 
-    response = client1.chat.completions.create(
+    response_text = openai_chat(
+        "video_suggestion",
         model="gpt-4o",
         messages=[
             {"role": "system", "content": "Ты креативный директор, который адаптирует видео-контент под бренд компании."},
@@ -483,118 +2160,270 @@ def create_video_suggestion(transcription, company_context):
         ],
         temperature=0.7
     )
-    return response.choices[0].message.content
+    return response_text
+
+
+FINGERPRINT_COLUMN = "AI отпечаток"
+AI_COLUMNS = [
+    "Предложение по посту", "Предложение по видео", "Тема поста", "Формат",
+    "Стиль", "CTA", "Заголовок", "Длина заголовка",
+    "✅ Научный факт/исследование", "✅ Конкретная польза (как сделать)",
+    "✅ Призыв комментировать", "Инсайт/заметка", "Фильтр", FINGERPRINT_COLUMN
+]
+# Колонки, которые заполняет каждый этап
+STAGE_COLUMNS = {
+    "analysis": ["Тема поста", "Формат", "Стиль", "CTA", "Заголовок", "Длина заголовка",
+                 "✅ Научный факт/исследование", "✅ Конкретная польза (как сделать)",
+                 "✅ Призыв комментировать", "Инсайт/заметка", "Фильтр"],
+    "rewrite": ["Предложение по посту"],
+    "video": ["Предложение по видео"],
+}
+
+
+def stage_fingerprints(post_text: str, video_url: str, company_context: str) -> dict:
+    """Hash of each AI stage's inputs; a stage whose stored hash matches is not re-run"""
+    def digest(stage, *inputs):
+        payload = json.dumps([stage, PROMPT_VERSIONS[stage], *inputs], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
 
+    return {
+        "analysis": digest("analysis", post_text, ctx.openai_sys_role),
+        "rewrite": digest("rewrite", post_text, company_context, ctx.openai_sys_role),
+        "video": digest("video", video_url, company_context, ctx.pegasus_sys_role),
+    }
 
-def complete_ai_analysis_for_sheet(company_id: int, company_name: str, company_context: str, post_num: int, worksheet):
-    """Complete AI analysis for all posts in the sheet including video processing"""
-    headers = worksheet.row_values(1)
-    new_data = worksheet.get_values(f"2:{post_num + 1}")
-    
+
+def _parse_fingerprints(value: str) -> dict:
+    try:
+        stored = json.loads(value)
+    except (TypeError, ValueError):
+        return {}
+    return stored if isinstance(stored, dict) else {}
+
+
+def complete_ai_analysis_for_sheet(company_id: int, company_name: str, company_context: str, headers, new_data, worksheet,
+                                   on_flush=None):
+    """Complete AI analysis for all posts including video processing.
+
+    new_data are the rows already written to the sheet below the header row, in the same order;
+    they are filled in place, and finished rows are written back every CHECKPOINT_FLUSH_ROWS rows
+    or CHECKPOINT_FLUSH_INTERVAL seconds, then on_flush() is called. On error the finished rows are flushed too.
+    Stages whose inputs are unchanged since the last run (see stage_fingerprints) are skipped:
+    the hashes come from the row's own fingerprint cell or, for freshly inserted rows, from the
+    results stored by post link, whose values are copied into the row.
+    """
+    post_num = len(new_data)
     post_text_col = headers.index("Пост - Текст поста")
     video_url_col = headers.index(
         "Ссылка на видео") if "Ссылка на видео" in headers else -1
 
-    ai_columns = [
-        "Предложение по посту", "Предложение по видео", "Тема поста", "Формат",
-        "Стиль", "CTA", "Заголовок", "Длина заголовка",
-        "✅ Научный факт/исследование", "✅ Конкретная польза (как сделать)",
-        "✅ Призыв комментировать", "Инсайт/заметка", "Фильтр"
-    ]
-
-    for col in ai_columns:
-        if col not in headers:
-            headers.append(col)
-
-    if len(headers) > worksheet.col_count:
-        worksheet.add_cols(len(headers) - worksheet.col_count)
-
-    worksheet.update(range_name="1:1", values=[headers])
+    sheet_writer.log(company_id, company_name, f"🔄 Обрабатываем {post_num} строк с полным AI анализом...")
 
-    admin_log.insert_row([company_id, company_name, f"🔄 Обрабатываем {post_num} строк с полным AI анализом...", datetime.today().isoformat()], 2)
+    post_texts = [str(row[post_text_col]) if post_text_col < len(row) else "" for row in new_data]
+    video_urls = [str(row[video_url_col]) if 0 <= video_url_col < len(row) else "" for row in new_data]
+    to_analyze = [i for i, text in enumerate(post_texts) if text.strip()]
 
-    enhanced_rows = []
-    for i, row in enumerate(new_data):
-        logger.info(f"Обрабатываем строку {i+1}...")
+    fingerprint_col = headers.index(FINGERPRINT_COLUMN)
+    stored_fingerprints = [_parse_fingerprints(row[fingerprint_col]) if fingerprint_col < len(row) else {}
+                           for row in new_data]
+    fingerprints = {i: stage_fingerprints(post_texts[i], video_urls[i].strip(), company_context) for i in to_analyze}
 
+    # Вставленные строки приходят с пустым отпечатком: если пост уже анализировался
+    # с теми же входами, берём результаты этапов по ссылке поста, а не пересчитываем
+    link_col = headers.index("Ссылка на пост")
+    post_links = [str(row[link_col]) if link_col < len(row) else "" for row in new_data]
+    reused_rows = set()
+    for i in to_analyze:
+        if stored_fingerprints[i] or not post_links[i]:
+            continue
+        previous = ai_results_cache.get(f"{company_id}:{post_links[i]}")
+        if not previous:
+            continue
+        reused = {stage: value for stage, value in previous["fingerprint"].items()
+                  if stage in STAGE_COLUMNS and fingerprints[i].get(stage) == value}
+        if not reused:
+            continue
+        row = new_data[i]
         while len(row) < len(headers):
             row.append("")
+        for stage in reused:
+            for col_name in STAGE_COLUMNS[stage]:
+                row[headers.index(col_name)] = previous["values"].get(col_name, "")
+        row[fingerprint_col] = json.dumps(reused, sort_keys=True)
+        stored_fingerprints[i] = reused
+        reused_rows.add(i)
+
+    def is_stale(i, stage):
+        return stored_fingerprints[i].get(stage) != fingerprints[i][stage]
+
+    analysis_rows = [i for i in to_analyze if is_stale(i, "analysis")]
+    rewrite_rows = [i for i in to_analyze if is_stale(i, "rewrite")]
+    video_rows = [i for i in to_analyze if video_urls[i].strip() and is_stale(i, "video")]
+    stale_rows = set(analysis_rows) | set(rewrite_rows) | set(video_rows)
+    if len(stale_rows) < len(to_analyze):
+        logger.info(f"⏭ Строк без изменений: {len(to_analyze) - len(stale_rows)}, пропускаем")
+    # перенесённые результаты ещё нужно записать в лист
+    if not stale_rows and not reused_rows:
+        return
 
-        post_text = row[post_text_col] if post_text_col < len(row) else ""
-        video_url = row[video_url_col] if video_url_col >= 0 and video_url_col < len(
-            row) else ""
-
-        if not post_text.strip():
-            enhanced_rows.append(row)
-            continue
-        
-        start_time = time.time()
-        analysis = rewrite_post_into_blocks(post_text)
-        end_time = time.time()
-
-        logger.info(f"Пост проанализирован за {end_time - start_time:.2f} секунд")
-        
-        start_time = time.time()
-        rewritten_post = rewrite_post_with_context(post_text, company_context)
-        end_time = time.time()
-
-        logger.info(f"Пост переписан за {end_time - start_time:.2f} секунд")
-
-        # Video processing
-        video_suggestion = ""
-        if video_url.strip():
-            logger.info(f"🎥 Обрабатываем видео: {video_url}")
+    def rewrite_stage(i):
+        with metrics.span("ai_stage_seconds", client=company_id, stage="rewrite"):
+            return rewrite_post_with_context(post_texts[i], company_context)
+
+    def suggestion_stage(transcription):
+        # перевод -> сюжет, запускается, как только готово описание видео
+        if not transcription:
+            return ""
+
+        with metrics.span("ai_stage_seconds", client=company_id, stage="translation"):
+            translated_transcription = translate_into_russian(
+                transcription)
+
+        with metrics.span("ai_stage_seconds", client=company_id, stage="video_suggestion"):
+            video_suggestion = create_video_suggestion(
+                translated_transcription, company_context)
+        return video_suggestion
+
+    def analysis_stage(texts):
+        with metrics.span("ai_stage_seconds", client=company_id, stage="analysis_batch"):
+            return rewrite_posts_into_blocks(texts)
+
+    def start_video_stage(video_url) -> Future:
+        logger.info(f"🎥 Обрабатываем видео: {video_url}")
+        cached = get_cached_video(video_url)
+        if cached.get("summary"):
+            return ai_pool.submit(suggestion_stage, cached["summary"])
+        if cached.get("video_id"):
+            return ai_pool.submit(lambda: suggestion_stage(summarize_video(
+                video_url, cached.get("index_id"), cached["video_id"], reindex_on_error=True)))
+        # Индексация идёт в фоне, пул не простаивает в ожидании TwelveLabs
+        indexed = video_queue.submit(video_url)
+        return chain_future(indexed, lambda ids: suggestion_stage(summarize_video(video_url, *ids)), ai_pool)
+
+    # Анализ (пакетами по ANALYSIS_BATCH_SIZE), переписывание и видео не зависят друг от друга,
+    # поэтому все ветки всех строк запускаются сразу; нагрузку на API ограничивают семафоры
+    enhanced_rows = []
+    flushed = 0
+    last_flush = time.monotonic()
+
+    def flush():
+        # строки завершаются по порядку, поэтому пишем только новый непрерывный кусок
+        nonlocal flushed, last_flush
+        last_flush = time.monotonic()
+        if len(enhanced_rows) > flushed:
+            worksheet.update(range_name=f"{flushed + 2}:{len(enhanced_rows) + 1}", values=enhanced_rows[flushed:])
+            flushed = len(enhanced_rows)
+            if on_flush:
+                on_flush()
+
+    ai_pool = ThreadPoolExecutor(max_workers=AI_MAX_WORKERS)
+    video_queue = VideoIndexingQueue(company_id)
+    try:
+        # Текстовые ветки запускаем первыми: проверка видео читает файлы по сети и не должна их задерживать
+        analysis_futures = {}
+        for b in range(0, len(analysis_rows), ANALYSIS_BATCH_SIZE):
+            batch = analysis_rows[b:b + ANALYSIS_BATCH_SIZE]
+            future = ai_pool.submit(analysis_stage, [post_texts[i] for i in batch])
+            for pos, i in enumerate(batch):
+                analysis_futures[i] = (future, pos)
+        rewrite_futures = {i: ai_pool.submit(rewrite_stage, i) for i in rewrite_rows}
+        # Затем ставим в очередь все видео, индексация идёт параллельно с текстовыми ветками
+        # Размер, длительность и отпечаток видео проверяем заранее: копии одного ролика
+        # получают общий результат, неподходящие ролики не индексируются
+        video_plan = prepare_videos(video_urls[i].strip() for i in video_rows)
+        skipped_video = Future()
+        skipped_video.set_result("")
+        video_stages = {}
+        video_futures = {}
+        for i in video_rows:
+            target = video_plan[video_urls[i].strip()]
+            if target is None:
+                video_futures[i] = skipped_video
+                continue
+            if target not in video_stages:
+                video_stages[target] = start_video_stage(target)
+            video_futures[i] = video_stages[target]
+
+        deferred = False
+        for i, row in enumerate(new_data):
+            while len(row) < len(headers):
+                row.append("")
+
+            if i not in stale_rows:
+                enhanced_rows.append(row)
+                continue
+
+            # Заполняем только пересчитанные этапы, отпечаток этапа сохраняем после его успеха
+            col_mapping = {}
+            fingerprint = dict(stored_fingerprints[i])
             try:
-                start_time = time.time()
-                transcription = transcribe_video(video_url.strip())
-                end_time = time.time()
-
-                logger.info(f"Видео транскрибированно за {end_time - start_time:.2f} секунд")
-
-                if transcription:
-                    start_time = time.time()
-                    translated_transcription = translate_into_russian(
-                        transcription)
-                    end_time = time.time()
-
-                    logger.info(f"Транскрипт переведен за {end_time - start_time:.2f} секунд")
+                if i in analysis_futures:
+                    batch_future, pos = analysis_futures[i]
+                    analysis = batch_future.result()[pos]
+                    col_mapping.update({
+                        "Тема поста": analysis.get("tema", ""),
+                        "Формат": analysis.get("format", ""),
+                        "Стиль": analysis.get("style", ""),
+                        "CTA": analysis.get("cta", ""),
+                        "Заголовок": analysis.get("zagolovok_5_slov", ""),
+                        "Длина заголовка": analysis.get("zagolovok_len", 0),
+                        "✅ Научный факт/исследование": analysis.get("fact", ""),
+                        "✅ Конкретная польза (как сделать)": analysis.get("benefit", ""),
+                        "✅ Призыв комментировать": analysis.get("comment_call", ""),
+                        "Инсайт/заметка": analysis.get("insight", ""),
+                        "Фильтр": analysis.get("filter", "")
+                    })
+                    fingerprint["analysis"] = fingerprints[i]["analysis"]
+                if i in rewrite_futures:
+                    col_mapping["Предложение по посту"] = rewrite_futures[i].result()
+                    fingerprint["rewrite"] = fingerprints[i]["rewrite"]
+            except BatchPending:
+                # Ответы придут пакетом OpenAI, строки заполним повторным проходом
+                deferred = True
+            if i in video_futures:
+                try:
+                    col_mapping["Предложение по видео"] = video_futures[i].result()
+                    fingerprint["video"] = fingerprints[i]["video"]
+                except BatchPending:
+                    deferred = True
+                except Exception as e:
+                    e = twelvelabs_error(e)
+                    col_mapping["Предложение по видео"] = ""
+                    sheet_writer.log(company_id, company_name, f"Ошибка при обработке видео в посте {i+1}: {e}")
+                    logger.warning(f"Ошибка при обработке видео в посте {i+1}: {e}")
+            col_mapping[FINGERPRINT_COLUMN] = json.dumps(fingerprint, sort_keys=True)
+
+            for col_name, value in col_mapping.items():
+                if col_name in headers:
+                    col_idx = headers.index(col_name)
+                    row[col_idx] = value
+            if post_links[i] and fingerprint:
+                ai_results_cache.set(f"{company_id}:{post_links[i]}", {
+                    "fingerprint": fingerprint,
+                    "values": {col_name: row[headers.index(col_name)]
+                               for stage in fingerprint for col_name in STAGE_COLUMNS[stage]},
+                })
 
-                    start_time = time.time()
-                    video_suggestion = create_video_suggestion(
-                        translated_transcription, company_context)
-                    end_time = time.time()
+            enhanced_rows.append(row)
+            logger.info(f"  ✅ Строка {i+1} обработана")
+            if (len(enhanced_rows) - flushed >= CHECKPOINT_FLUSH_ROWS
+                    or time.monotonic() - last_flush >= CHECKPOINT_FLUSH_INTERVAL):
+                flush()
+    except Exception:
+        video_queue.close()
+        ai_pool.shutdown(wait=False, cancel_futures=True)
+        # Готовые строки сохраняем, чтобы повторный запуск их пропустил
+        try:
+            flush()
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось сохранить готовые строки: {e}")
+        raise
+    video_queue.close()
+    ai_pool.shutdown()
 
-                    logger.info(f"Сгенерирован новый сюжет видео за {end_time - start_time:.2f} секунд")
-            except Exception as e:
-                admin_log.insert_row([company_id, company_name, f"Ошибка при обработке видео в посте {i+1}: {e}", datetime.today().isoformat()], 2)
-                logger.warning(f"Ошибка при обработке видео в посте {i+1}: {e}")
-
-        # Update row with all AI data
-        col_mapping = {
-            "Предложение по посту": rewritten_post,
-            "Предложение по видео": video_suggestion,
-            "Тема поста": analysis.get("tema", ""),
-            "Формат": analysis.get("format", ""),
-            "Стиль": analysis.get("style", ""),
-            "CTA": analysis.get("cta", ""),
-            "Заголовок": analysis.get("zagolovok_5_slov", ""),
-            "Длина заголовка": analysis.get("zagolovok_len", 0),
-            "✅ Научный факт/исследование": analysis.get("fact", ""),
-            "✅ Конкретная польза (как сделать)": analysis.get("benefit", ""),
-            "✅ Призыв комментировать": analysis.get("comment_call", ""),
-            "Инсайт/заметка": analysis.get("insight", ""),
-            "Фильтр": analysis.get("filter", "")
-        }
-
-        for col_name, value in col_mapping.items():
-            if col_name in headers:
-                col_idx = headers.index(col_name)
-                row[col_idx] = value
-
-        enhanced_rows.append(row)
-        logger.info(f"  ✅ Строка {i+1} обработана")
-
-    worksheet.update(range_name=f"2:{post_num+1}", values=enhanced_rows)
+    flush()
+    if deferred:
+        raise BatchPending(f"AI анализ компании {company_name} ждёт пакет OpenAI")
 
     logger.info(f"✅ Полный AI анализ завершен для компании {company_name} c id {company_id}")
     logger.info(f"📊 Обработано строк: {len(enhanced_rows)}")
@@ -612,15 +2441,19 @@ async def extract_context(spreadsheet):
     return top_left_cell
 
 # ------------------ RUN ------------------
-async def process_table(company_id: int, company_name: str, company_url: str, days_back=60):
+async def process_table(company_id: int, company_name: str, company_url: str, days_back=DAYS_BACK_FULL, incremental=False):
+    """Collect top posts of the client's channels into Рекомендации and run the AI analysis.
+
+    If the AI requests went to the OpenAI batch, returns a function that finishes the analysis
+    once the batch is done; otherwise returns None.
+    """
     logger.info(f"🔄 Обрабатываем таблицу клиента {company_name} c id {company_id}...")
     try: 
-        spreadsheet = gs_client.open_by_url(company_url)
+        spreadsheet = ctx.gs_client.open_by_url(company_url)
     except:
         raise Exception("Неверный URL")
-    company_context = await extract_context(spreadsheet)
-    # TODO: what if table not exist
-    channels_sheet = get_or_create_worksheet(spreadsheet, CHANNELS)
+    # Профиль компании входит почти в каждый промпт клиента, поэтому сжимаем его один раз
+    company_context = compact_text(await extract_context(spreadsheet), COMPANY_CONTEXT_MAX_TOKENS, "company_context")
     # TODO: what if table not exist
     suggestions_sheet = get_or_create_worksheet(spreadsheet, SUGGESTIONS)
     # TODO: should always update?
@@ -638,50 +2471,98 @@ async def process_table(company_id: int, company_name: str, company_url: str, da
         "Комментарии",
         "Репосты",
         "Вовлеченность"
-    ]
+    ] + AI_COLUMNS
+    if len(suggestions_headers) > suggestions_sheet.col_count:
+        suggestions_sheet.add_cols(len(suggestions_headers) - suggestions_sheet.col_count)
     suggestions_sheet.update(range_name='1:1', values=[suggestions_headers])
 
-    # --- Сбор информации о каналах ---
-    raw_channels = extract_channels_from_sheet(channels_sheet)
-    channel_infos = []
-    for ch in raw_channels:
-        try:
-            channel_id = ch.strip()
-            info = get_channel_info(channel_id)
-            if info:
-                channel_infos.append(info)
-        except Exception as e:
-            # Warning
-            admin_log.insert_row([company_id, company_name, f"Ошибка при обработке {channel_id}: {e}", datetime.today().isoformat()], 2)
-
-    if not channel_infos:
-        raise Exception("Каналы не найдены")
-
-    # Сохраняем в Google Sheets
-    save_to_sheet_channels(channel_infos, channels_sheet)
-
-    # --- Логируем ---
-    admin_log.insert_row([company_id, company_name, f"Обработано {len(channel_infos)} каналов", datetime.today().isoformat()], 2)
+    checkpoint = Checkpoint(company_id)
+    if checkpoint.stage:
+        # Каналы и посты уже собраны прошлым запуском, продолжаем с места остановки
+        logger.info(f"♻️ Клиент {company_name}: продолжаем с контрольной точки '{checkpoint.stage}'")
+        sheet_writer.log(company_id, company_name, f"Продолжаем с контрольной точки '{checkpoint.stage}'")
+        rows = checkpoint.state["rows"]
+        delta = DeltaState(company_id, checkpoint.state["incremental"])
+        delta.restore_watermarks(checkpoint.state["watermarks"])
+    else:
+        # TODO: what if table not exist
+        channels_sheet = SheetModel(get_or_create_worksheet(spreadsheet, CHANNELS))
+
+        # --- Сбор информации о каналах ---
+        raw_channels = extract_channels_from_sheet(channels_sheet.values)
+        channel_infos = []
+        with metrics.span("stage_seconds", client=company_id, stage="channels"):
+            for ch, (info, error) in zip(raw_channels, resolve_channels(raw_channels)):
+                if error:
+                    # Warning
+                    sheet_writer.log(company_id, company_name, f"Ошибка при обработке {ch.strip()}: {error}")
+                elif info:
+                    channel_infos.append(info)
+
+        if not channel_infos:
+            raise Exception("Каналы не найдены")
+
+        # Сохраняем в Google Sheets
+        save_to_sheet_channels(channel_infos, channels_sheet)
+
+        # --- Логируем ---
+        sheet_writer.log(company_id, company_name, f"Обработано {len(channel_infos)} каналов")
+
+        # --- Сбор постов ---
+        # Каналы берём из памяти, а не перечитываем только что записанный лист
+        data = [ch for ch in channel_infos if ch.get('ID') and ch.get('Название канала')]
+        delta = DeltaState(company_id, incremental)
+        with metrics.span("stage_seconds", client=company_id, stage="posts"):
+            rows = extract_top_posts(company_id, company_name, data, days_back, top_n=10, delta=delta)
+        metrics.inc("posts_selected_total", len(rows), client=company_id)
+
+        logger.info(f"Всего выбрано постов: {len(rows)}")
+
+        if not rows:
+            if incremental:
+                sheet_writer.log(company_id, company_name, "Новых постов нет")
+                delta.commit()
+                return
+            raise Exception("Нет постов")
+
+        checkpoint.save("posts", rows=rows, incremental=incremental, watermarks=delta.pending_watermarks())
+
+    if checkpoint.stage == "inserting":
+        # Упали во время вставки: если строки уже в листе, второй раз их не вставляем
+        link_col = suggestions_headers.index("Ссылка на пост")
+        sheet_links = [row[link_col] if link_col < len(row) else ""
+                       for row in suggestions_sheet.get_values(f"2:{len(rows) + 1}")]
+        if sheet_links == [str(row[link_col]) for row in rows]:
+            checkpoint.save("inserted")
+        else:
+            checkpoint.save("posts")
 
-    # --- Сбор постов ---
-    channels_data = channels_sheet.get_all_records()
-    data = [ch for ch in channels_data if ch.get('ID') and ch.get('Название канала')]
-    rows = extract_top_posts(company_id, company_name, data, days_back, top_n=10)
+    if checkpoint.stage == "posts":
+        # --- Сохраняем в Google Sheets ---
+        checkpoint.save("inserting")
+        suggestions_sheet.insert_rows(rows, value_input_option='RAW', row=2)
+        checkpoint.save("inserted")
 
-    logger.info(f"Всего выбрано постов: {len(rows)}")
+        # --- Логируем ---
+        sheet_writer.log(company_id, company_name, f"Собрано {len(rows)} рекомендаций")
 
-    if not rows:
-        raise Exception("Нет постов")
+    def finish_ai_analysis():
+        with metrics.span("stage_seconds", client=company_id, stage="ai_analysis"):
+            complete_ai_analysis_for_sheet(company_id, company_name, company_context, suggestions_headers, rows,
+                                           suggestions_sheet, on_flush=lambda: checkpoint.save("ai", rows=rows))
 
-    # --- Сохраняем в Google Sheets ---
-    suggestions_sheet.insert_rows(rows, value_input_option='RAW', row=2)
+        # Водяные знаки сдвигаем только после успешного анализа
+        delta.mark_processed(row[3] for row in rows)
+        delta.commit()
+        checkpoint.clear()
 
-    # --- Логируем ---
-    admin_log.insert_row([company_id, company_name, f"Собрано {len(rows)} рекомендаций", datetime.today().isoformat()], 2)
+        sheet_writer.log(company_id, company_name, "AI анализ завершен")
 
-    complete_ai_analysis_for_sheet(company_id, company_name, company_context, len(rows), suggestions_sheet)
-    
-    admin_log.insert_row([company_id, company_name, "AI анализ завершен", datetime.today().isoformat()], 2)
+    try:
+        finish_ai_analysis()
+    except BatchPending:
+        sheet_writer.log(company_id, company_name, "AI запросы отправлены в пакет OpenAI")
+        return finish_ai_analysis
  
     
 
@@ -704,8 +2585,49 @@ def get_col_idx(col_name, headers):
 #     admin_main.update_cell(i+2, status_col+1, 'In progress')
     # admin_main.update_cell(i+2, updated_col+1, datetime.today().strftime('%Y-%m-%d'))
 
+def run_client(client, status_col: int, processing_col: int, resume=None):
+    """Process one client table and update its status in Main.
+
+    Returns True if it succeeded, False on error, or the continuation from process_table if the client
+    waits for the OpenAI batch; after the batch it is called again with that continuation as `resume`.
+    """
+    i, client_id, client_name, client_url, client_status = client
+    sheet_writer.update_cell(i+2, processing_col+1, 'В исполнении')
+    try:
+        with metrics.span("client_seconds", client=client_id):
+            if resume is not None:
+                resume()
+            elif client_status == 'Start':
+                resume = asyncio.run(process_table(client_id, client_name, client_url))
+            else:
+                resume = asyncio.run(process_table(client_id, client_name, client_url, DAYS_BACK_INCREMENTAL, incremental=True))
+        if resume is not None and openai_batch.collecting:
+            sheet_writer.update_cell(i+2, processing_col+1, 'Ждёт пакет OpenAI')
+            return resume
+        if client_status == 'Start':
+            sheet_writer.update_cell(i+2, status_col+1, 'In progress')
+        sheet_writer.update_cell(i+2, processing_col+1, 'Готово')
+        metrics.inc("clients_total", status="done")
+        return True
+    except PermissionDeniedError:
+        sheet_writer.log(client_id, client_name, "Ошибка OpenAI API: включите VPN")
+        logger.error(f"Ошибка OpenAI API: включите VPN")
+    except RateLimitError:
+        sheet_writer.log(client_id, client_name, "Ошибка OpenAI API: исчерпан лимит запросов")
+        logger.error(f"Ошибка OpenAI API: исчерпан лимит запросов")
+    except AuthenticationError:
+        sheet_writer.log(client_id, client_name, "Ошибка OpenAI API: ошибка аутентификации")
+        logger.error(f"Ошибка OpenAI API: ошибка аутентификации")
+    except Exception as e:
+        sheet_writer.log(client_id, client_name, str(e))
+        logger.error(str(e))
+    sheet_writer.update_cell(i+2, processing_col+1, 'Ошибка')
+    metrics.inc("clients_total", status="error")
+    return False
+
+
 def main():
-    all_data = admin_main.get_all_values()
+    all_data = ctx.admin_main.get_all_values()
     if not all_data:
         logger.error(f"Лист '{MAIN}' пустой")
         return
@@ -731,53 +2653,69 @@ def main():
 
             if client_status == 'Start' or client_status == 'In progress':
                 if not client_id.isdigit():
-                    admin_log.insert_row([client_id, client_name, f"Неправильный id '{client_id}' для клиента в строке {i}", datetime.today().isoformat()], 2)
+                    sheet_writer.log(client_id, client_name, f"Неправильный id '{client_id}' для клиента в строке {i}")
                     logger.error(f"Неправильный id '{client_id}' для клиента в строке {i}")
-                    admin_main.update_cell(i+2, processing_col+1, 'Ошибка')
+                    sheet_writer.update_cell(i+2, processing_col+1, 'Ошибка')
                 client_id = int(client_id)
                 if client_name and client_url:
                     clients_to_process.append((i, client_id, client_name, client_url, client_status))
-                    admin_main.update_cell(i+2, processing_col+1, 'В ожидании...')
+                    sheet_writer.update_cell(i+2, processing_col+1, 'В ожидании...')
                 else:
-                    admin_log.insert_row([client_id, client_name, f"Не указано название или ссылка на таблицу для клиента в строке {i}", datetime.today().isoformat()], 2)
+                    sheet_writer.log(client_id, client_name, f"Не указано название или ссылка на таблицу для клиента в строке {i}")
                     logger.error(f"Не указано название или ссылка на таблицу для клиента в строке {i}")
-                    admin_main.update_cell(i+2, processing_col+1, 'Ошибка')
+                    sheet_writer.update_cell(i+2, processing_col+1, 'Ошибка')
         
-        for client in clients_to_process:
-            i, client_id, client_name, client_url, client_status = client 
-            admin_main.update_cell(i+2, processing_col+1, 'В исполнении')
-            try:
-                if client_status == 'Start':
-                    asyncio.run(process_table(client_id, client_name, client_url))
-                    admin_main.update_cell(i+2, status_col+1, 'In progress')
-                else:
-                    asyncio.run(process_table(client_id, client_name, client_url, 7))
-                admin_main.update_cell(i+2, processing_col+1, 'Готово')
-            except PermissionDeniedError:
-                admin_log.insert_row([client_id, client_name, "Ошибка OpenAI API: включите VPN", datetime.today().isoformat()], 2)
-                logger.error(f"Ошибка OpenAI API: включите VPN")
-                admin_main.update_cell(i+2, processing_col+1, 'Ошибка')
-            except RateLimitError:
-                admin_log.insert_row([client_id, client_name, "Ошибка OpenAI API: исчерпан лимит запросов", datetime.today().isoformat()], 2)
-                logger.error(f"Ошибка OpenAI API: исчерпан лимит запросов")
-                admin_main.update_cell(i+2, processing_col+1, 'Ошибка')
-            except AuthenticationError:
-                admin_log.insert_row([client_id, client_name, "Ошибка OpenAI API: ошибка аутентификации", datetime.today().isoformat()], 2)
-                logger.error(f"Ошибка OpenAI API: ошибка аутентификации")
-                admin_main.update_cell(i+2, processing_col+1, 'Ошибка')
-            except Exception as e:
-                admin_log.insert_row([client_id, client_name, str(e), datetime.today().isoformat()], 2)
-                logger.error(str(e))
-                admin_main.update_cell(i+2, processing_col+1, 'Ошибка')
-        
-        for client in clients_to_process:
-            i, client_id, client_name, client_url, client_status = client
-            if admin_main.cell(i+2, processing_col+1).value == 'Готово':
-                admin_main.update_cell(i+2, processing_col+1, '')
+        # Клиенты не зависят друг от друга: ошибка одного не останавливает остальных.
+        # Общие каналы клиентов запрашиваются один раз, с самым широким окном прогона
+        shared_fetches.start_run(max((DAYS_BACK_FULL if client[4] == 'Start' else DAYS_BACK_INCREMENTAL
+                                      for client in clients_to_process), default=0))
+        openai_batch.collecting = OPENAI_BATCH_MODE
+        with ThreadPoolExecutor(max_workers=MAX_PARALLEL_CLIENTS) as executor:
+            results = list(executor.map(lambda client: run_client(client, status_col, processing_col), clients_to_process))
+
+            if OPENAI_BATCH_MODE:
+                # Один пакет на всех клиентов, затем второй проход по тем же строкам берёт ответы из кэша
+                openai_batch.collecting = False
+                sheet_writer.flush()
+                logger.info(f"📦 Отправляем в OpenAI Batch API {len(openai_batch)} запросов")
+                try:
+                    logger.info(f"📦 Получено ответов из пакета: {openai_batch.run()}")
+                except openai.OpenAIError as e:
+                    logger.error(f"Ошибка OpenAI Batch API, запросы будут выполнены напрямую: {e}")
+                waiting = [n for n, result in enumerate(results) if callable(result)]
+                resumed = executor.map(lambda n: run_client(clients_to_process[n], status_col, processing_col, results[n]), waiting)
+                for n, result in zip(waiting, list(resumed)):
+                    results[n] = result
+        shared_fetches.clear()
+        done_rows = [client[0] for client, done in zip(clients_to_process, results) if done is True]
+
+        # Статусы известны локально, перечитывать Main не нужно
+        for i in done_rows:
+            sheet_writer.update_cell(i+2, processing_col+1, '')
     
     except Exception as e:
         logger.error(str(e))
+
+    sheet_writer.flush()
+    for name, cache in (("post_stats", post_stats_cache), ("llm", llm_cache), ("video", video_cache),
+                        ("channels", channel_registry), ("ai_results", ai_results_cache)):
+        metrics.inc("cache_hits_total", cache.hits, cache=name)
+        metrics.inc("cache_misses_total", cache.misses, cache=name)
+    metrics.log_summary()
+    if METRICS_EXPORT_PATH:
+        try:
+            metrics.export(METRICS_EXPORT_PATH)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось сохранить метрики в {METRICS_EXPORT_PATH}: {e}")
+    post_stats_cache.log_stats("статистики постов")
+    llm_cache.log_stats("ответов LLM")
+    video_cache.log_stats("видео")
+    channel_registry.log_stats("каналов")
+    ai_results_cache.log_stats("результатов AI анализа")
         
 
 if __name__ == "__main__":
+    # --resume: повторный запуск после сбоя продолжает клиентов с контрольных точек
+    if "--resume" in sys.argv[1:]:
+        RESUME_MODE = True
     main()
@@ -0,0 +1,128 @@
+"""Pipeline checks on the bench fakes: shared fetches, no duplicate rows, AI reuse and resume"""
+import asyncio
+import importlib
+import logging
+import os
+
+import pytest
+
+import bench
+
+
+@pytest.fixture(scope="module")
+def g(tmp_path_factory):
+    # пути кэшей и адрес TGStat читаются при импорте, поэтому окружение задаём до него
+    cache_dir = tmp_path_factory.mktemp("cache")
+    server = bench.start_tgstat_server(bench.load_fixture("tgstat.json"), 0, 8)
+    saved = dict(os.environ)
+    os.environ.update({
+        "CACHE_DIR": str(cache_dir),
+        "TGSTAT_BASE_URL": f"http://127.0.0.1:{server.server_port}",
+        "TGSTAT_API_KEY": "bench",
+        "LLM_CACHE_BYPASS": "1",
+        "VIDEO_POLL_MIN_INTERVAL": "0.05",
+        "VIDEO_POLL_MAX_INTERVAL": "0.2",
+    })
+    import get_stats
+    get_stats = importlib.reload(get_stats)
+    get_stats.logger.setLevel(logging.WARNING)
+    get_stats.EXTRACTED_DATA_DIR = str(cache_dir / "extracted_data")
+    yield get_stats
+    server.shutdown()
+    os.environ.clear()
+    os.environ.update(saved)
+
+
+def make_clients(g, prefix, clients, channels):
+    """Fake admin sheet and one spreadsheet per client, all reading the same channels"""
+    sheets = bench.load_fixture("sheets.json")
+    links = [["link"]] + [[f"https://t.me/{prefix}_{i}"] for i in range(channels)]
+    spreadsheets = {}
+    suggestions = []
+    main_rows = [["id", "Name", "URL", "Scheduler Status", "Processing"]]
+    for client in range(clients):
+        url = f"https://docs.google.com/spreadsheets/d/{prefix}-{client}"
+        worksheet = bench.FakeWorksheet(g.SUGGESTIONS, 0)
+        spreadsheets[url] = bench.FakeSpreadsheet({
+            g.PROFILE: bench.FakeWorksheet(g.PROFILE, 0, [[sheets["profile"]]]),
+            g.CHANNELS: bench.FakeWorksheet(g.CHANNELS, 0, links),
+            g.SUGGESTIONS: worksheet,
+        }, 0)
+        suggestions.append(worksheet)
+        main_rows.append([str(client + 1), f"{prefix}-{client}", url, "Start", ""])
+    g.ctx.override(
+        openai=bench.FakeOpenAI(bench.load_fixture("openai.json"), 0),
+        twelvelabs=bench.FakeTwelveLabs(bench.load_fixture("twelvelabs.json"), 0),
+        gs_client=bench.FakeGspread(spreadsheets),
+        admin_main=bench.FakeWorksheet(g.MAIN, 0, main_rows),
+        admin_log=bench.FakeWorksheet(g.LOG, 0),
+        openai_sys_role="sys",
+        pegasus_sys_role="peg",
+    )
+    return list(spreadsheets), suggestions
+
+
+def post_links(worksheet):
+    return [row[3] for row in worksheet.get_all_values()[1:]]
+
+
+def ai_calls():
+    return {k: v for k, v in bench.CALLS.counts.items() if k.startswith(("openai", "twelvelabs"))}
+
+
+def test_shared_channels_are_fetched_once(g):
+    _, suggestions = make_clients(g, "shared", clients=2, channels=3)
+    bench.CALLS.counts.clear()
+    g.main()
+
+    assert bench.CALLS.counts["tgstat channels/get"] == 3
+    assert bench.CALLS.counts["tgstat channels/posts"] == 3
+    # статистика поста запрашивается не больше одного раза на оба клиента
+    assert 0 < bench.CALLS.counts["tgstat posts/stat"] <= 3 * 50
+    for worksheet in suggestions:
+        links = post_links(worksheet)
+        assert links
+        assert len(links) == len(set(links))
+
+
+def test_second_run_reuses_ai_results(g):
+    (url,), (worksheet,) = make_clients(g, "rerun", clients=1, channels=3)
+    bench.CALLS.counts.clear()
+    asyncio.run(g.process_table(1, "rerun", url))
+    first = post_links(worksheet)
+    assert first and ai_calls()
+
+    bench.CALLS.counts.clear()
+    asyncio.run(g.process_table(1, "rerun", url))
+    assert ai_calls() == {}
+    # каждый прогон вставляет свои строки сверху, прошлые остаются историей
+    links = post_links(worksheet)
+    assert len(links) == 2 * len(first)
+    assert sorted(links[:len(first)]) == sorted(first)
+
+
+def test_resume_after_crash_does_not_duplicate_rows(g, monkeypatch):
+    (url,), (worksheet,) = make_clients(g, "resume", clients=1, channels=3)
+    save = g.Checkpoint.save
+
+    def crash_after_insert(self, stage, **state):
+        if stage == "inserted":
+            raise KeyboardInterrupt
+        return save(self, stage, **state)
+
+    monkeypatch.setattr(g.Checkpoint, "save", crash_after_insert)
+    with pytest.raises(KeyboardInterrupt):
+        asyncio.run(g.process_table(2, "resume", url))
+    inserted = post_links(worksheet)
+    assert inserted
+    assert g.checkpoints_store.get("2")["stage"] == "inserting"
+
+    monkeypatch.setattr(g.Checkpoint, "save", save)
+    monkeypatch.setattr(g, "RESUME_MODE", True)
+    bench.CALLS.counts.clear()
+    asyncio.run(g.process_table(2, "resume", url))
+
+    links = post_links(worksheet)
+    assert sorted(links) == sorted(inserted)
+    assert not any(k.startswith("tgstat") for k in bench.CALLS.counts)
+    assert g.checkpoints_store.get("2") is None